@@ -2,31 +2,90 @@
 """api.py - contains game logic and high-level API Implementation"""
 
 
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime
+
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
-from models import User, Game, Score
+from models import User, Game, Score, COMPUTER_NAME, fetch_user_names
 from models import (
     StringMessage, NewGameForm, GameForm, MakeMoveForm, ScoreForms, 
-    GetHighScoresForm, UserRankingsForm, UserRankingForm, UserGamesForm)
-from utils import get_by_urlsafe
+    GetHighScoresForm, UserRankingsForm, UserRankingForm, UserGamesForm,
+    HintForm, GameStatsForm, GameReplayForm, MoveForm, CacheStatsForm,
+    BatchMovesForm, BatchMoveResultForm, BatchMoveResultsForm,
+    MatchTicketForm, MatchmakingStatsForm, ContentionStatsForm)
+from instrumentation import instrumented
+from utils import get_key_by_urlsafe, check_kind
+import board
+import contention
+import game_cache
+import matchmaking
+import movelog
+import stats
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_HIGH_SCORES_REQUEST = endpoints.ResourceContainer(GetHighScoresForm)
-GET_USER_RANKINGS_REQUEST = endpoints.ResourceContainer()
+GET_USER_RANKINGS_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+GET_GAME_VERSION_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    known_version=messages.IntegerField(2),)
+WAIT_FOR_MOVE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    known_version=messages.IntegerField(2, required=True),
+    timeout=messages.IntegerField(3),)
 GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),)
+GET_GAME_REPLAY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    ply=messages.IntegerField(2),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
-MEMCACHE_MOVES = 'MOVES'
+GET_SCORES_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),
+    start_date=messages.StringField(3),
+    end_date=messages.StringField(4),)
+GET_USER_SCORES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3),
+    start_date=messages.StringField(4),
+    end_date=messages.StringField(5),)
+GET_CONTENTION_STATS_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),)
+ENQUEUE_MATCH_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    max_rating_diff=messages.IntegerField(2),)
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+DATE_FORMAT = '%Y-%m-%d'
+MAX_BATCH_MOVES = 500
+# Errors make_moves reports for the moves of one game: a ServiceException,
+# a key of another kind (check_kind) or a key the datastore rejects, e.g.
+# one of another app
+GAME_ERRORS = (endpoints.ServiceException, ValueError, datastore_errors.Error)
+# Attempts of a move transaction before the move is given up, and the upper
+# bound of the random backoff before the first retry, doubled for each retry
+MOVE_ATTEMPTS = 4
+MOVE_BACKOFF_SECONDS = 0.05
+# wait_for_move timeouts in seconds, kept well below the request deadline
+DEFAULT_WAIT_SECONDS = 20
+MAX_WAIT_SECONDS = 25
+WAIT_POLL_SECONDS = 0.5
 
 @endpoints.api(name='tic_tac_toe', version='v1')
 class TicTacToeApi(remote.Service):
@@ -36,25 +95,83 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a new User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if request.user_name == COMPUTER_NAME:
+            raise endpoints.ConflictException(
+                    'That name is reserved for the computer player!')
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
+    @endpoints.method(request_message=ENQUEUE_MATCH_REQUEST,
+                      response_message=MatchTicketForm,
+                      path='matchmaking',
+                      name='enqueue_match',
+                      http_method='POST')
+    @instrumented
+    def enqueue_match(self, request):
+        """Waits for an opponent. Players are paired in the background; a
+        max_rating_diff only accepts opponents within that rating range.
+        Poll get_match for the new game."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        if request.max_rating_diff is not None and request.max_rating_diff < 0:
+            raise endpoints.BadRequestException(
+                'max_rating_diff can not be negative')
+        return matchmaking.enqueue(user, request.max_rating_diff).to_form()
+
+    @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
+                      response_message=MatchTicketForm,
+                      path='matchmaking/{user_name}',
+                      name='get_match',
+                      http_method='GET')
+    @instrumented
+    def get_match(self, request):
+        """Returns whether a player in the queue was matched, and the game"""
+        ticket = matchmaking.MatchTicket.get_by_id(request.user_name)
+        if not ticket:
+            raise endpoints.NotFoundException(
+                    'That user is not waiting for a match!')
+        return ticket.to_form()
+
+    @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
+                      response_message=StringMessage,
+                      path='matchmaking/{user_name}',
+                      name='leave_matchmaking',
+                      http_method='DELETE')
+    @instrumented
+    def leave_matchmaking(self, request):
+        """Takes a player that was not matched yet out of the queue"""
+        if not matchmaking.leave(request.user_name):
+            raise endpoints.NotFoundException(
+                    'That user is not waiting for a match!')
+        return StringMessage(message='Left the matchmaking queue')
+
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
-        """Creates a new game"""
-        user = User.query(User.name == request.user_name).get()
-        opponent = User.query(User.name == request.opponent_name).get()
+        """Creates a new game. Without an opponent_name the game is played
+        against the computer."""
+        user = User.get_by_name(request.user_name)
+        single_player = not request.opponent_name
+        if single_player:
+            if (request.board_size != board.DEFAULT_BOARD_SIZE or
+                    request.win_length != board.DEFAULT_WIN_LENGTH):
+                raise endpoints.BadRequestException(
+                    'The computer only plays on the 3x3 board')
+            opponent = User.get_computer()
+        else:
+            opponent = User.get_by_name(request.opponent_name)
 
         if not user or not opponent:
             raise endpoints.NotFoundException(
@@ -62,12 +179,15 @@ class TicTacToeApi(remote.Service):
         if user == opponent:
             raise endpoints.ForbiddenException(
                 'A user can not play by themselves')
-        game = Game.new_game(user.key, opponent.key)
-
-        # Use a task queue to update the average moves.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_moves')
+        if not board.is_valid_variant(request.board_size, request.win_length):
+            raise endpoints.BadRequestException(
+                'Board size must be between {} and {} and the win length '
+                'between {} and the board size'.format(
+                    board.DEFAULT_BOARD_SIZE, board.MAX_BOARD_SIZE,
+                    board.DEFAULT_WIN_LENGTH))
+        game = Game.new_game(user.key, opponent.key,
+                             request.board_size, request.win_length,
+                             single_player)
         return game.to_form('Good luck playing Tic Tac Toe!')
 
     @endpoints.method(request_message=GET_HIGH_SCORES_REQUEST,
@@ -75,168 +195,608 @@ class TicTacToeApi(remote.Service):
                       path='scores/high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
-        """Returns a list of high scores in descending order"""
-        sorted_scores = sorted(Score.query(), 
-            key=lambda x: x.moves, reverse=True)
-        return ScoreForms(items=[score.to_form() for score in sorted_scores])
+        """Returns a page of the best scores, fewest moves to win first"""
+        page_size, cursor = self._page_params(
+            request.number_of_results, request.cursor, 'number_of_results')
+        scores, next_cursor, more = Score.query(Score.won == True).order(
+            Score.moves).fetch_page(page_size, start_cursor=cursor)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_cursor=next_cursor.urlsafe() if more else None)
+
+    @staticmethod
+    def _page_params(page_size, cursor, size_field='page_size'):
+        """Validates the paging parameters of a request. Returns the page
+        size and the Cursor to start from."""
+        page_size = page_size or DEFAULT_PAGE_SIZE
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                '{} must be between 1 and {}'.format(size_field,
+                                                     MAX_PAGE_SIZE))
+        try:
+            return page_size, Cursor(urlsafe=cursor)
+        except Exception:
+            raise endpoints.BadRequestException('Invalid cursor')
+
+    def _fetch_scores_page(self, request, query, projection):
+        """Returns a ScoreForms page of the query, newest scores first,
+        limited to the request's date range and read with a projection"""
+        page_size, cursor = self._page_params(request.page_size,
+                                              request.cursor)
+        try:
+            if request.start_date:
+                query = query.filter(Score.date >= datetime.strptime(
+                    request.start_date, DATE_FORMAT).date())
+            if request.end_date:
+                query = query.filter(Score.date <= datetime.strptime(
+                    request.end_date, DATE_FORMAT).date())
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Dates must be formatted as YYYY-MM-DD')
+        return query.order(-Score.date).fetch_page(
+            page_size, start_cursor=cursor, projection=projection)
 
     @endpoints.method(request_message=GET_USER_RANKINGS_REQUEST,
                       response_message=UserRankingsForm, 
                       path='scores/user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Returns the ranking of all players by number of games won"""
-        ranked_users = User.query().order(-User.performance)
-        return UserRankingsForm(users=[user.to_rank_form() for user in ranked_users])
+        """Returns a page of the players ranked by rating, best first"""
+        page_size, cursor = self._page_params(request.page_size,
+                                              request.cursor)
+        users, next_cursor, more = User.query().order(
+            -User.rating).fetch_page(page_size, start_cursor=cursor)
+        # The computer is not ranked
+        users = [user for user in users if user.name != COMPUTER_NAME]
+        forms, rank = [], None
+        for i, user in enumerate(users):
+            if user.rating is None:
+                # Not rated by /tasks/backfill_ratings yet; these sort last
+                forms.append(user.to_rank_form())
+                continue
+            if rank is None:
+                rank = User.get_rank(user.rating)
+            elif user.rating < users[i - 1].rating:
+                rank = forms[0].rank + i
+            forms.append(user.to_rank_form(rank))
+        return UserRankingsForm(
+            users=forms, next_cursor=next_cursor.urlsafe() if more else None)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
+                      response_message=UserRankingForm,
+                      path='scores/user_rankings/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Returns the rating and rank of a player"""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        if user.rating is None:
+            return user.to_rank_form()
+        return user.to_rank_form(User.get_rank(user.rating))
+
+    @endpoints.method(request_message=GET_GAME_VERSION_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Returns the current state of the game given urlsafe_game_key."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Returns the current state of the game given urlsafe_game_key.
+        If known_version is the current version of the game, only a
+        not_modified GameForm is returned."""
+        game = game_cache.get_game(request.urlsafe_game_key, Game)
         if game:
+            if game.version == request.known_version:
+                return game.to_not_modified_form()
             return game.to_form('Time to make a move!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=WAIT_FOR_MOVE_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_move',
+                      http_method='GET')
+    @instrumented
+    def wait_for_move(self, request):
+        """Waits until the game moves past known_version or the timeout (in
+        seconds) runs out. Returns the new game state, or a not_modified
+        GameForm on timeout. The game is polled in the cache, not the
+        datastore."""
+        timeout = request.timeout or DEFAULT_WAIT_SECONDS
+        if not 0 < timeout <= MAX_WAIT_SECONDS:
+            raise endpoints.BadRequestException(
+                'timeout must be between 1 and {}'.format(MAX_WAIT_SECONDS))
+        deadline = time.time() + timeout
+        while True:
+            game = game_cache.get_game(request.urlsafe_game_key, Game)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            if game.version != request.known_version:
+                return game.to_form('Time to make a move!')
+            if time.time() + WAIT_POLL_SECONDS > deadline:
+                return game.to_not_modified_form()
+            time.sleep(WAIT_POLL_SECONDS)
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
-        """Performs the move and returns the updated game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        user_making_move = User.query(User.name == request.player_name).get()
-        player_one = game.user.get()
-        player_two = game.opponent.get()
-        
-        # Fetch opponent information
-        if(user_making_move is player_one):
-            opponent = player_two
+        """Performs the move and returns the updated game state. Raises a
+        ConflictException if the game is too busy to take the move."""
+        user_future = User.get_by_name_async(request.player_name)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key)
+        user_making_move = user_future.get_result()
+        if not user_making_move:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        game, outcomes = self._play_async(
+            game_key, [(user_making_move, request.move)]).get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if isinstance(outcomes[0], endpoints.ServiceException):
+            raise outcomes[0]
+        return game.to_form(outcomes[0])
+
+    @endpoints.method(request_message=BatchMovesForm,
+                      response_message=BatchMoveResultsForm,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    def make_moves(self, request):
+        """Performs a batch of moves, possibly in many games, and returns a
+        result for every move. Moves are applied in order with the same
+        rules as make_move; a rejected move does not stop the others. The
+        moves of each game are made in one transaction and the games are
+        played in parallel."""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves can be made at once'.format(MAX_BATCH_MOVES))
+        users = User.get_by_names(entry.player_name for entry in request.moves)
+
+        results, by_game = [], OrderedDict()
+        for entry in request.moves:
+            result = BatchMoveResultForm(urlsafe_game_key=entry.urlsafe_game_key)
+            results.append(result)
+            user_making_move = users.get(entry.player_name)
+            if not user_making_move:
+                result.message = 'A User with that name does not exist!'
+                continue
+            by_game.setdefault(entry.urlsafe_game_key, []).append(
+                (result, user_making_move, entry.move))
+
+        futures = {}
+        for urlsafe, entries in by_game.items():
+            try:
+                futures[urlsafe] = self._play_async(
+                    get_key_by_urlsafe(urlsafe),
+                    [(user, move) for _, user, move in entries])
+            except GAME_ERRORS, e:
+                for result, _, _ in entries:
+                    result.message = str(e)
+
+        played = {}
+        for urlsafe, future in futures.items():
+            entries = by_game[urlsafe]
+            try:
+                game, outcomes = future.get_result()
+                if not game:
+                    raise endpoints.NotFoundException('Game not found!')
+            except GAME_ERRORS, e:
+                for result, _, _ in entries:
+                    result.message = str(e)
+                continue
+            played[urlsafe] = game
+            for (result, _, _), outcome in zip(entries, outcomes):
+                if isinstance(outcome, endpoints.ServiceException):
+                    result.message = str(outcome)
+                else:
+                    result.ok, result.message = True, outcome
+
+        # Every result shows the state of its game after the whole batch
+        names = fetch_user_names([key for game in played.values()
+                                  for key in (game.user, game.opponent)])
+        for result in results:
+            if result.ok:
+                result.game = played[result.urlsafe_game_key].to_form(
+                    result.message, names)
+        return BatchMoveResultsForm(results=results)
+
+    @classmethod
+    @ndb.tasklet
+    def _play_async(cls, game_key, moves):
+        """Makes a list of (user, move) pairs in a game, in a transaction on
+        the game. A commit that conflicts with another request is retried
+        after a random backoff, up to MOVE_ATTEMPTS times. Returns (game,
+        outcomes) with the message or the ServiceException of every move;
+        game is None if it does not exist. Raises a ConflictException if
+        every attempt conflicted."""
+        conflicts = 0
+        for attempt in range(MOVE_ATTEMPTS):
+            try:
+                game, outcomes, deltas, ending = (
+                    yield cls._play_transaction_async(game_key, moves))
+                break
+            except datastore_errors.TransactionFailedError:
+                conflicts += 1
+                if attempt + 1 < MOVE_ATTEMPTS:
+                    yield ndb.sleep(random.uniform(
+                        0, MOVE_BACKOFF_SECONDS * 2 ** attempt))
         else:
-            opponent = player_one
+            contention.record(game_key, conflicts=conflicts,
+                              failures=len(moves))
+            raise endpoints.ConflictException(
+                'The game is busy, please try the move again')
+        contention.record(game_key, moves=len(moves), conflicts=conflicts)
+
+        # Counters are only written once the moves are committed
+        futures = []
+        if any(deltas.values()):
+            futures.append(stats.record_async(**deltas))
+        if ending:
+            futures.append(game.record_result_async(*ending))
+        yield futures
+        raise ndb.Return((game, outcomes))
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True, retries=0)
+    def _play_transaction_async(cls, game_key, moves):
+        """Reads the game and makes the moves in one attempt of the move
+        transaction. Returns (game, outcomes, deltas, ending), where deltas
+        holds the changes to the running statistics and ending the
+        arguments of record_result_async if the game ended."""
+        game = check_kind((yield game_key.get_async()), Game)
+        if not game:
+            raise ndb.Return((None, [], {}, None))
+        user_moves, outcomes, endings = game.user_moves, [], []
+        # Players are compared by key, also while they are being moved to
+        # the key of their name
+        game.follow_moved_users([user for user, _ in moves])
+        # A game from before the running statistics is counted in them the
+        # first time it is written
+        deltas = {} if game.counted else game.stats_deltas()
+        game.counted = True
+        for user_making_move, move in moves:
+            try:
+                outcomes.append(cls._apply_move(game, user_making_move, move,
+                                                endings))
+            except endpoints.ServiceException, e:
+                outcomes.append(e)
+
+        ending = None
+        if endings:
+            # finish_async writes the game together with both players
+            won, draw = endings[0]
+            rating_changes = yield game.finish_async(won, draw)
+            ending = (won, draw, rating_changes)
+        elif not all(isinstance(outcome, Exception) for outcome in outcomes):
+            yield game.put_async()
+        else:
+            raise ndb.Return((game, outcomes, {}, None))
+        deltas['active_user_moves'] = (deltas.get('active_user_moves', 0) +
+                                       game.user_moves - user_moves)
+        raise ndb.Return((game, outcomes, deltas, ending))
 
+    @classmethod
+    def _apply_move(cls, game, user_making_move, move, endings):
+        """Validates and applies a move by user_making_move, plus the
+        computer's reply in single player games. If the move ends the game,
+        (won, draw) is added to endings. Returns the message for the move
+        or raises a ForbiddenException for an illegal move."""
         # Validate the move format and make sure game is not over
         if game.game_over:
             raise endpoints.ForbiddenException(
                 'Illegal Action: Game is already over.')
-        if(request.move not in range(9)):
+        cell_count = len(game.board_state)
+        if not 1 <= move <= cell_count:
             raise endpoints.ForbiddenException(
-                'Illegal Action: Move outside the range (1-9)')
+                'Illegal Action: Move outside the range (1-{})'.format(
+                    cell_count))
 
-        board_ind = request.move - 1
+        if game.single_player and user_making_move.key != game.user:
+            raise endpoints.ForbiddenException(
+                'Illegal Action: The computer makes its own moves.')
+
+        board_ind = move - 1
         if(game.board_state[board_ind] == 0):
-            if(user_making_move is player_one):
-                game.board_state[board_ind] = 1    
+            if(user_making_move.key == game.user):
+                player = 1
                 game.user_moves += 1
             else: 
-                game.board_state[board_ind] = 2
+                player = 2
                 game.opponent_moves += 1
+            game.board_state[board_ind] = player
         else:
             raise endpoints.ForbiddenException(
                 'Illegal Move: The slot is already filled.')
-        
-        winner = game.is_game_over()
-        if winner != 0:
-            game.moves_history.append("Player: {}, Move: {}, Status: {} || ".format(
-              user_making_move.name, str(request.move), "Game Over"))
-            if(winner == 1):
-                game.end_game(True)
-                return game.to_form('You win!')
-            else:
-                game.end_game(False)
-                return game.to_form('You lose!')
-        game.moves_history.append("Player: {}, Move: {}, Status: {} || ".format(
-          user_making_move.name, str(request.move), "Active"))
-        game.put()
-        return game.to_form(user_making_move.name + ' made a move!')
+
+        finished = cls._check_game_over(game, player, board_ind, endings)
+
+        if not finished and game.single_player:
+            # The solver is only loaded by instances serving the computer
+            import solver
+            computer_ind = solver.best_move(game.board_state)
+            game.board_state[computer_ind] = 2
+            game.opponent_moves += 1
+            finished = cls._check_game_over(game, 2, computer_ind, endings)
+
+        if finished:
+            return finished
+        return user_making_move.name + ' made a move!'
+
+    @staticmethod
+    def _check_game_over(game, player, board_ind, endings):
+        """Records a move in the game history and marks the game over if the
+        move finished it, adding (won, draw) to endings. Returns the message
+        for a finished game, or None if the game goes on"""
+        game.record_move(board_ind, player)
+        winner = game.is_game_over(board_ind)
+        if winner == 0 and not game.is_board_full():
+            return None
+        game.game_over = True
+        if(winner == 1):
+            endings.append((True, False))
+            return 'You win!'
+        elif(winner == 2):
+            endings.append((False, False))
+            return 'You lose!'
+        endings.append((False, True))
+        return 'Draw!'
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+        """Returns the best move for the player whose turn it is."""
+        game = game_cache.get_game(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.ForbiddenException('Game is already over!')
+        if game.board_size != board.DEFAULT_BOARD_SIZE:
+            raise endpoints.BadRequestException(
+                'Hints are only available on the 3x3 board')
+        import solver
+        result = solver.lookup(game.board_state)
+        if result is None:
+            move, score = solver.minimax_best_move(game.board_state)
+        else:
+            move, score = result
+        return HintForm(move=move + 1, outcome=solver.describe(score))
     
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game', 
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
-        """Cancels the given game and returns a feedback message."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Cancels the given game and returns a feedback message. The game
+        is checked and deleted in a transaction, so a game finished by a
+        concurrent move is never cancelled."""
+        try:
+            game = self._cancel_transaction(
+                get_key_by_urlsafe(request.urlsafe_game_key))
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'The game is busy, please try again')
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.counted:
+            stats.record(active_games=-1, active_user_moves=-game.user_moves,
+                         cancelled_games=1)
+        else:
+            stats.record(cancelled_games=1)
+        return StringMessage(message="Game has been successfully deleted!")
+
+    @staticmethod
+    @ndb.transactional
+    def _cancel_transaction(game_key):
+        """Deletes a game that is not over. Returns the deleted game, or
+        None if it does not exist."""
+        game = check_kind(game_key.get(), Game)
         if game:
             if game.game_over:
                 raise endpoints.ForbiddenException('Game is already over!')
-            game.key.delete()  
-            return StringMessage(message="Game has been successfully deleted!")
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+            game.key.delete()
+        return game
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=GET_SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Returns all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Returns a page of scores, newest first"""
+        scores, next_cursor, more = self._fetch_scores_page(
+            request, Score.query(),
+            [Score.user, Score.date, Score.won, Score.moves])
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_cursor=next_cursor.urlsafe() if more else None)
 
     @endpoints.method(request_message=GET_USER_GAMES_REQUEST, 
                       response_message=UserGamesForm, 
                       path='user/games/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
         """Returns all active games of the given user"""
-        user = User.query(User.name == request.user_name).get()
-        active_games = [game.to_form("Active game") for game in Game.fetch_active_games(user)]
-        return UserGamesForm(games=active_games)
+        user = User.get_by_name(request.user_name)
+        active_games = Game.fetch_active_games(user).fetch()
+        return UserGamesForm(games=Game.to_forms(active_games, "Active game"))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=GET_USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all scores for a given user"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of scores for a given user, newest first"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        # The user is filtered on, so it can not be projected
+        scores, next_cursor, more = self._fetch_scores_page(
+            request, Score.query(Score.user == user.key),
+            [Score.date, Score.won, Score.moves])
+        return ScoreForms(items=Score.to_forms(scores, user=user),
+                          next_cursor=next_cursor.urlsafe() if more else None)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Return the history of moves given a urlsafe_game_key."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = game_cache.get_game(request.urlsafe_game_key, Game)
         if game:
-            moves = ", ".join(game.moves_history)
-            return StringMessage(message=moves or '')
+            if game.moves_history:
+                # Not migrated to the packed move log yet
+                return StringMessage(message=", ".join(game.moves_history))
+            players = game.player_names()
+            moves = game.get_moves()
+            history = []
+            for ply, (board_ind, player) in enumerate(moves, 1):
+                over = game.game_over and ply == len(moves)
+                history.append("Player: {}, Move: {}, Status: {} || ".format(
+                    players[player], board_ind + 1,
+                    "Game Over" if over else "Active"))
+            return StringMessage(message=", ".join(history))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_GAME_REPLAY_REQUEST,
+                      response_message=GameReplayForm,
+                      path='game/{urlsafe_game_key}/replay',
+                      name='get_game_replay',
+                      http_method='GET')
+    @instrumented
+    def get_game_replay(self, request):
+        """Returns the moves of a game and the board after the given ply
+        (the latest board by default)."""
+        game = game_cache.get_game(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        moves = game.get_moves()
+        ply = len(moves) if request.ply is None else request.ply
+        if not 0 <= ply <= len(moves):
+            raise endpoints.BadRequestException(
+                'ply must be between 0 and {}'.format(len(moves)))
+        players = game.player_names()
+        return GameReplayForm(
+            urlsafe_key=game.key.urlsafe(),
+            ply=ply,
+            board_state=movelog.replay(moves, game.board_size, ply),
+            moves=[MoveForm(ply=i, player_name=players[player],
+                            move=board_ind + 1)
+                   for i, (board_ind, player) in enumerate(moves, 1)])
+
     @endpoints.method(response_message=StringMessage,
                       path='games/average_moves',
                       name='get_average_move',
                       http_method='GET')
+    @instrumented
     def get_average_moves(self, request):
-        """Returns the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES) or '')
+        """Returns the average moves made in active games"""
+        totals = stats.get_totals()
+        if not totals['active_games']:
+            return StringMessage(message='')
+        average = float(totals['active_user_moves']) / totals['active_games']
+        return StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average))
 
-    @staticmethod
-    def _cache_average_moves():
-        """Populates memcache with the average moves of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_moves = sum([game.user_moves for game in games])
-            average = float(total_moves)/count
-            memcache.set(MEMCACHE_MOVES,
-                         'The average moves remaining is {:.2f}'.format(average))
+    @endpoints.method(response_message=GameStatsForm,
+                      path='games/stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+        """Returns running statistics of active and finished games"""
+        totals = stats.get_totals()
+        active = totals['active_games']
+        finished = totals['finished_games']
+
+        def ratio(count, total):
+            return float(count) / total if total else 0.0
+
+        return GameStatsForm(
+            active_games=active,
+            average_moves=ratio(totals['active_user_moves'], active),
+            finished_games=finished,
+            average_game_length=ratio(totals['finished_moves'], finished),
+            user_win_ratio=ratio(totals['user_wins'], finished),
+            opponent_win_ratio=ratio(totals['opponent_wins'], finished),
+            draw_ratio=ratio(totals['draws'], finished),
+            cancelled_games=totals['cancelled_games'],
+            computer_wins=totals['computer_wins'],
+            computer_losses=totals['computer_losses'])
+
+    @endpoints.method(response_message=CacheStatsForm,
+                      path='games/cache_stats',
+                      name='get_cache_stats',
+                      http_method='GET')
+    @instrumented
+    def get_cache_stats(self, request):
+        """Returns the hit rate and eviction counts of the game cache"""
+        counts = game_cache.get_stats()
+        reads = counts['hits'] + counts['misses']
+        return CacheStatsForm(
+            hit_rate=float(counts['hits']) / reads if reads else 0.0,
+            **counts)
+
+    @endpoints.method(request_message=GET_CONTENTION_STATS_REQUEST,
+                      response_message=ContentionStatsForm,
+                      path='games/contention_stats',
+                      name='get_contention_stats',
+                      http_method='GET')
+    @instrumented
+    def get_contention_stats(self, request):
+        """Returns how often moves conflicted with a concurrent change of
+        their game, over all games or for the given game"""
+        game_key = None
+        if request.urlsafe_game_key:
+            game_key = get_key_by_urlsafe(request.urlsafe_game_key)
+        counts = contention.get_counts(game_key)
+        requested = counts['moves'] + counts['failures']
+        return ContentionStatsForm(
+            conflicts_per_move=(float(counts['conflicts']) / requested
+                                if requested else 0.0),
+            **counts)
+
+    @endpoints.method(response_message=MatchmakingStatsForm,
+                      path='games/matchmaking_stats',
+                      name='get_matchmaking_stats',
+                      http_method='GET')
+    @instrumented
+    def get_matchmaking_stats(self, request):
+        """Returns the number of players waiting and the average time
+        players waited for a match"""
+        totals = stats.get_totals()
+        matched = totals['matched_players']
+        waited = totals['match_wait_ms'] / 1000.0
+        return MatchmakingStatsForm(
+            queue_depth=totals['queued_players'],
+            matched_players=matched,
+            average_time_to_match=waited / matched if matched else 0.0)
 
 api = endpoints.api_server([TicTacToeApi])
@@ -0,0 +1,132 @@
+"""archive.py - Compact archive of finished games.
+
+Games finished more than ARCHIVE_AFTER_DAYS ago are moved out of the Game
+kind in batches, so the indexes the active game queries run on stop
+growing with every game ever played. Archived games are no longer found by
+get_game, wait_for_move, get_game_history and get_game_replay; the grace
+period leaves players time to read the end of their games.
+A GameArchive holds up to ARCHIVE_BATCH_SIZE games as columns: one packed
+array per field with a value per game, the moves of all games in one array
+and the final boards of all games in another. Players are stored once per
+archive and referenced by index. Arrays are little-endian so they can be
+read straight into NumPy (see tools/archive_analytics.py).
+
+The move values are the packed movelog values, (board index << 1) |
+(player - 1), widened to two bytes so every game uses the same width."""
+
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+
+from models import Game, fetch_user_names
+import board
+
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_AFTER_DAYS = 7
+# GameArchive.results values
+RESULT_DRAW = 0
+RESULT_USER_WON = 1
+RESULT_OPPONENT_WON = 2
+# Typecodes of the packed columns
+COLUMNS = (('user_index', 'H'), ('opponent_index', 'H'),
+           ('board_size', 'B'), ('win_length', 'B'),
+           ('single_player', 'B'), ('results', 'B'), ('move_counts', 'H'))
+MOVES_TYPECODE = 'H'
+BOARDS_TYPECODE = 'B'
+
+
+def pack(typecode, values):
+    """Packs integers into a little-endian byte string"""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def unpack(typecode, data):
+    """Returns the list of integers in a little-endian byte string"""
+    packed = array(typecode)
+    packed.fromstring(data or '')
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tolist()
+
+
+class GameArchive(ndb.Model):
+    """A batch of finished games packed into columns"""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    count = ndb.IntegerProperty(required=True)
+    game_keys = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    players = ndb.KeyProperty(kind='User', repeated=True, indexed=False)
+    user_index = ndb.BlobProperty()
+    opponent_index = ndb.BlobProperty()
+    board_size = ndb.BlobProperty()
+    win_length = ndb.BlobProperty()
+    single_player = ndb.BlobProperty()
+    results = ndb.BlobProperty()
+    move_counts = ndb.BlobProperty()
+    # Moves and final boards of all games, one after the other
+    moves = ndb.BlobProperty(compressed=True)
+    boards = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def from_games(cls, games):
+        """Returns an unsaved GameArchive of a list of finished games, keyed
+        by the first game so that archiving the same batch again replaces
+        the archive instead of adding a copy"""
+        players, columns = {}, dict((name, []) for name, _ in COLUMNS)
+        moves, boards = [], []
+        for game in games:
+            for key in (game.user, game.opponent):
+                players.setdefault(key, len(players))
+            game_moves = game.get_moves()
+            won = board.winner(game.board_state, game.board_size,
+                               game.win_length)
+            columns['user_index'].append(players[game.user])
+            columns['opponent_index'].append(players[game.opponent])
+            columns['board_size'].append(game.board_size)
+            columns['win_length'].append(game.win_length)
+            columns['single_player'].append(int(bool(game.single_player)))
+            columns['results'].append(
+                {1: RESULT_USER_WON, 2: RESULT_OPPONENT_WON}.get(
+                    won, RESULT_DRAW))
+            columns['move_counts'].append(len(game_moves))
+            moves.extend(index << 1 | (player - 1)
+                         for index, player in game_moves)
+            boards.extend(game.board_state)
+        archive = cls(id='from-{}'.format(games[0].key.id()),
+                      count=len(games), game_keys=[g.key for g in games],
+                      players=sorted(players, key=players.get),
+                      moves=pack(MOVES_TYPECODE, moves),
+                      boards=pack(BOARDS_TYPECODE, boards))
+        for name, typecode in COLUMNS:
+            setattr(archive, name, pack(typecode, columns[name]))
+        return archive
+
+    def column(self, name):
+        """Returns the values of one packed column as a list"""
+        typecode = dict(COLUMNS)[name]
+        return unpack(typecode, getattr(self, name))
+
+
+def compact_batch(batch_size=ARCHIVE_BATCH_SIZE):
+    """Archives the batch of games that finished first, at least
+    ARCHIVE_AFTER_DAYS ago, and deletes them. Returns the number of games
+    archived. If the deletes are interrupted the remaining games are
+    archived again with the next batch; readers drop the duplicates by game
+    key."""
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    # Active games have no finish time, which sorts before every cutoff
+    games = Game.query(Game.game_over == True, Game.finished < cutoff).order(
+        Game.finished).fetch(batch_size)
+    if not games:
+        return 0
+    # Games still holding the deprecated move strings are converted first
+    names = fetch_user_names([game.user for game in games])
+    for game in games:
+        game.migrate_moves_history(names)
+    GameArchive.from_games(games).put()
+    ndb.delete_multi([game.key for game in games])
+    return len(games)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""bench_api.py - Load generation and latency benchmark for TicTacToeApi.
+
+Runs the endpoints in-process against the local datastore, memcache and
+taskqueue stubs of the App Engine SDK. The traffic mix creates users, starts
+games between random pairs of them and plays the games to the end with
+interleaved moves, while reading games, histories, high scores, user games
+and statistics in between. For every endpoint it reports p50/p95/p99
+latency, throughput and the number of datastore and memcache RPCs per call.
+
+Run from the project folder:
+    python benchmarks/bench_api.py --sdk /path/to/google_appengine \\
+        --users 50 --games 200 --output results.json
+    python benchmarks/bench_api.py --sdk ... --compare results.json"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir)
+COUNTED_SERVICES = ('datastore_v3', 'memcache', 'taskqueue')
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and the project on sys.path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, PROJECT_DIR)
+
+
+def activate_testbed():
+    """Activates the local service stubs and returns the testbed"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # endpoints.api_server reads the minor version from CURRENT_VERSION_ID,
+    # which the testbed's default leaves out
+    bed.setup_env(current_version_id='testbed.version', overwrite=True)
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=PROJECT_DIR)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+class Recorder(object):
+    """Records the latency and RPC counts of every endpoint call"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        # Wall time from the first call of each endpoint to its last
+        self.spans = {}
+        self.rpcs = defaultdict(lambda: defaultdict(int))
+        self._current = None
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_api', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if self._current and service in COUNTED_SERVICES:
+            self.rpcs[self._current]['{}.{}'.format(service, call)] += 1
+
+    def call(self, name, method, request):
+        from google.appengine.ext import ndb
+        # Start every request with an empty context cache, like a new request
+        ndb.get_context().clear_cache()
+        self._current = name
+        start = time.time()
+        try:
+            return method(request)
+        finally:
+            end = time.time()
+            self.latencies[name].append(end - start)
+            self.spans[name] = (self.spans.get(name, (start,))[0], end)
+            self._current = None
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    index = max(0, int(round(fraction * len(ordered))) - 1)
+    return ordered[index]
+
+
+def run(args):
+    from protorpc import message_types
+    import api
+    from api import TicTacToeApi
+
+    rng = random.Random(args.seed)
+    service = TicTacToeApi()
+    recorder = Recorder()
+    recorder.install()
+
+    def request(container, **fields):
+        return container.combined_message_class(**fields)
+
+    names = ['player{}'.format(i) for i in range(args.users)]
+    for name in names:
+        recorder.call('create_user', service.create_user,
+                      request(api.USER_REQUEST, user_name=name,
+                              email='{}@example.com'.format(name)))
+
+    started = time.time()
+    active = {}
+    for _ in range(args.games):
+        user, opponent = rng.sample(names, 2)
+        form = recorder.call('new_game', service.new_game,
+                             request(api.NEW_GAME_REQUEST, user_name=user,
+                                     opponent_name=opponent))
+        active[form.urlsafe_key] = (user, opponent, form.board_state, 0)
+
+    finished = []
+    while active:
+        key = rng.choice(list(active))
+        user, opponent, board_state, ply = active[key]
+        player = user if ply % 2 == 0 else opponent
+        move = rng.choice([i for i, cell in enumerate(board_state)
+                           if cell == 0]) + 1
+        form = recorder.call('make_move', service.make_move,
+                             request(api.MAKE_MOVE_REQUEST,
+                                     urlsafe_game_key=key,
+                                     player_name=player, move=move))
+        if form.game_over:
+            del active[key]
+            finished.append(key)
+        else:
+            active[key] = (user, opponent, form.board_state, ply + 1)
+
+        # Interleave reads with the moves
+        roll = rng.random()
+        if roll < args.read_ratio * 0.4:
+            recorder.call('get_game', service.get_game,
+                          request(api.GET_GAME_VERSION_REQUEST,
+                                  urlsafe_game_key=key))
+        elif roll < args.read_ratio * 0.6:
+            recorder.call('get_user_games', service.get_user_games,
+                          request(api.GET_USER_GAMES_REQUEST,
+                                  user_name=rng.choice(names)))
+        elif roll < args.read_ratio * 0.75 and finished:
+            recorder.call('get_game_history', service.get_game_history,
+                          request(api.GET_GAME_REQUEST,
+                                  urlsafe_game_key=rng.choice(finished)))
+        elif roll < args.read_ratio * 0.9:
+            recorder.call('get_high_scores', service.get_high_scores,
+                          request(api.GET_HIGH_SCORES_REQUEST,
+                                  number_of_results=10))
+        elif roll < args.read_ratio:
+            recorder.call('get_game_stats', service.get_game_stats,
+                          message_types.VoidMessage())
+    elapsed = time.time() - started
+
+    endpoints = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        calls = len(latencies)
+        endpoints[name] = {
+            'calls': calls,
+            'p50_ms': percentile(latencies, 0.50) * 1e3,
+            'p95_ms': percentile(latencies, 0.95) * 1e3,
+            'p99_ms': percentile(latencies, 0.99) * 1e3,
+            # Calls per second of wall time, other endpoints' calls included
+            'throughput_per_s': calls / (recorder.spans[name][1] -
+                                         recorder.spans[name][0]),
+            'rpcs_per_call': dict(
+                (rpc, float(count) / calls)
+                for rpc, count in sorted(recorder.rpcs[name].items())),
+        }
+    return {
+        'config': {'users': args.users, 'games': args.games,
+                   'read_ratio': args.read_ratio, 'seed': args.seed},
+        'elapsed_s': elapsed,
+        'endpoints': endpoints,
+    }
+
+
+def report(results, baseline=None):
+    """Prints a table of the results, with the change in p50 latency and
+    datastore RPCs against a baseline run if one is given"""
+    print '{:<18} {:>6} {:>9} {:>9} {:>9} {:>10} {:>9}'.format(
+        'endpoint', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s',
+        'ds rpcs')
+    for name, row in sorted(results['endpoints'].items()):
+        datastore = sum(count for rpc, count in row['rpcs_per_call'].items()
+                        if rpc.startswith('datastore_v3.'))
+        line = '{:<18} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} {:>9.2f}'.format(
+            name, row['calls'], row['p50_ms'], row['p95_ms'], row['p99_ms'],
+            row['throughput_per_s'], datastore)
+        old = baseline and baseline['endpoints'].get(name)
+        if old:
+            old_datastore = sum(
+                count for rpc, count in old['rpcs_per_call'].items()
+                if rpc.startswith('datastore_v3.'))
+            line += '   p50 {:+.1f}%, ds rpcs {:+.2f}'.format(
+                (row['p50_ms'] / old['p50_ms'] - 1) * 100,
+                datastore - old_datastore)
+        print line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--read-ratio', type=float, default=0.5,
+                        help='chance of a read request after every move')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    bed = activate_testbed()
+    try:
+        results = run(args)
+    finally:
+        bed.deactivate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""bench_solver.py - Compares best move lookups in the precomputed solver
+table against an on-the-fly minimax search.
+
+Run from the project folder:
+    python benchmarks/bench_solver.py [number_of_positions]"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import board
+import solver
+
+
+def random_positions(count, seed=42):
+    """Returns undecided positions reached by random play, with at least
+    two moves made so the minimax side finishes in reasonable time"""
+    rng, positions = random.Random(seed), []
+    while len(positions) < count:
+        cells, player = [0] * solver.CELLS, 1
+        for _ in range(rng.randint(2, 7)):
+            empty = [i for i in range(solver.CELLS) if cells[i] == 0]
+            cells[rng.choice(empty)] = player
+            player = 3 - player
+            if board.winner(cells):
+                break
+        if not board.winner(cells) and 0 in cells:
+            positions.append(cells)
+    return positions
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    positions = random_positions(count)
+
+    build = timeit.timeit(solver.build_table, number=1)
+    solver.get_table()
+    lookup = timeit.timeit(
+        lambda: [solver.best_move(cells) for cells in positions], number=10)
+    search = timeit.timeit(
+        lambda: [solver.minimax_best_move(cells) for cells in positions],
+        number=1)
+
+    lookup_us = lookup / (10 * count) * 1e6
+    search_us = search / count * 1e6
+    print 'table entries:      {}'.format(len(solver.get_table()))
+    print 'table build:        {:.1f} ms'.format(build * 1e3)
+    print 'lookup per move:    {:.1f} us'.format(lookup_us)
+    print 'minimax per move:   {:.1f} us'.format(search_us)
+    print 'speedup:            {:.0f}x'.format(search_us / lookup_us)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""profile_startup.py - Cold start profile of the api and main WSGI apps.
+
+Every scenario runs in a fresh Python process on the local stubs of the App
+Engine SDK, like a new instance, and measures the time to import the app
+module and to answer its first request. Imports made by the app are timed
+one by one, so the slowest modules can be listed. The scenarios are:
+
+ - api: a new instance whose first request is an API call;
+ - main: a new instance whose first request is a task;
+ - warmup: a new instance that gets /_ah/warmup first and then the same API
+   call, the way App Engine starts instances with warmup requests enabled.
+
+Each scenario is repeated and the median is reported.
+
+Run from the project folder:
+    python benchmarks/profile_startup.py --sdk /path/to/google_appengine \\
+        --repeat 5 --output startup.json
+    python benchmarks/profile_startup.py --sdk ... --compare startup.json"""
+
+import __builtin__
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from bench_api import setup_sdk, activate_testbed
+
+SCENARIOS = ('api', 'main', 'warmup')
+API_CALL = '/_ah/spi/TicTacToeApi.get_game_stats'
+TASK_CALL = '/tasks/scan_reminders'
+
+
+class ImportTimer(object):
+    """Records the time spent importing each module, nested imports
+    included"""
+
+    def __init__(self):
+        self.times = {}
+        self._original = None
+
+    def install(self):
+        self._original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._original
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._original(name, *args, **kwargs)
+        start = time.time()
+        try:
+            return self._original(name, *args, **kwargs)
+        finally:
+            if name in sys.modules and name not in self.times:
+                self.times[name] = time.time() - start
+
+
+def request(app, path, method='GET', body=None):
+    """Sends one request to a WSGI app and returns the status code. Raises
+    a RuntimeError if the request failed, so a scenario never times an
+    error page."""
+    from webob import Request
+    req = Request.blank(path, method=method)
+    # Set by the endpoints frontend; the api app answers 404 without it
+    req.headers['X-AppEngine-Peer'] = 'apiserving'
+    if body is not None:
+        req.body = body
+        req.content_type = 'application/json'
+    status = req.get_response(app).status_int
+    if status >= 400:
+        raise RuntimeError('{} {} returned {}'.format(method, path, status))
+    return status
+
+
+def run_scenario(name):
+    """Runs one scenario in this process and returns its timings"""
+    bed = activate_testbed()
+    timer = ImportTimer()
+    timer.install()
+    modules_before = len(sys.modules)
+    result = {}
+    try:
+        start = time.time()
+        if name == 'warmup':
+            import main
+            result['import_ms'] = (time.time() - start) * 1e3
+            started = time.time()
+            request(main.app, '/_ah/warmup')
+            result['warmup_ms'] = (time.time() - started) * 1e3
+            start = time.time()
+        if name in ('api', 'warmup'):
+            import api
+            if name == 'api':
+                result['import_ms'] = (time.time() - start) * 1e3
+            started = time.time()
+            request(api.api, API_CALL, method='POST', body='{}')
+        else:
+            import main
+            result['import_ms'] = (time.time() - start) * 1e3
+            started = time.time()
+            request(main.app, TASK_CALL, method='POST')
+        result['first_response_ms'] = (time.time() - started) * 1e3
+        # From the instance taking user traffic to its first response
+        result['start_to_first_response_ms'] = (time.time() - start) * 1e3
+    finally:
+        timer.uninstall()
+        bed.deactivate()
+    result['modules_loaded'] = len(sys.modules) - modules_before
+    result['imports_ms'] = dict((module, seconds * 1e3)
+                                for module, seconds in timer.times.items())
+    return result
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def profile(args):
+    """Runs every scenario args.repeat times in new processes"""
+    results = {}
+    for name in SCENARIOS:
+        runs = []
+        for _ in range(args.repeat):
+            command = [sys.executable, __file__, '--scenario', name]
+            if args.sdk:
+                command += ['--sdk', args.sdk]
+            runs.append(json.loads(subprocess.check_output(command)))
+        summary = dict((field, median([run[field] for run in runs]))
+                       for field in runs[0] if field.endswith('_ms')
+                       and field != 'imports_ms')
+        summary['modules_loaded'] = median(
+            [run['modules_loaded'] for run in runs])
+        imports = runs[len(runs) // 2]['imports_ms']
+        summary['slowest_imports'] = sorted(
+            imports.items(), key=lambda item: -item[1])[:args.top]
+        results[name] = summary
+    return results
+
+
+def report(results, baseline=None):
+    """Prints the timings of every scenario, with the change in time to the
+    first response against a baseline run if one is given"""
+    for name in SCENARIOS:
+        row = results[name]
+        line = ('{:<7} import {:>7.1f} ms  first response {:>7.1f} ms  '
+                'start to first response {:>7.1f} ms  {} modules').format(
+                    name, row['import_ms'], row['first_response_ms'],
+                    row['start_to_first_response_ms'], row['modules_loaded'])
+        if 'warmup_ms' in row:
+            line += '  (warmup {:.1f} ms)'.format(row['warmup_ms'])
+        old = baseline and baseline.get(name)
+        if old:
+            line += '  {:+.1f}%'.format(
+                (row['start_to_first_response_ms'] /
+                 old['start_to_first_response_ms'] - 1) * 100)
+        print line
+        for module, ms in row['slowest_imports']:
+            print '    {:<40} {:>7.1f} ms'.format(module, ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest imports to list')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--scenario', choices=SCENARIOS,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        setup_sdk(args.sdk)
+        print json.dumps(run_scenario(args.scenario))
+        return
+
+    results = profile(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""stress_make_move.py - Concurrent make_move stress test on local stubs.
+
+Runs make_move from many threads at once against the datastore and
+memcache stubs of the App Engine SDK, which reject conflicting commits the
+same way the datastore does. Two scenarios are played:
+
+ - busy game: every thread makes moves in its own cells of one large game,
+   so all commits go to the same entity group;
+ - cell race: all threads try the same cell of a fresh game at the same
+   moment, round after round.
+
+Afterwards the games are checked: the number of filled cells, the move
+counters, the move log and the number of successful requests must all
+agree, and exactly one thread may win each cell race. Throughput, latency
+percentiles and the conflict counters are reported.
+
+Run from the project folder:
+    python benchmarks/stress_make_move.py --sdk /path/to/google_appengine \\
+        --threads 8 --rounds 20"""
+
+import argparse
+import threading
+import time
+from collections import defaultdict
+
+from bench_api import setup_sdk, activate_testbed, percentile
+
+BUSY_BOARD_SIZE = 19
+
+
+class Outcomes(object):
+    """Thread-safe tally of request outcomes and latencies"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.latencies = []
+
+    def add(self, outcome, latency):
+        with self.lock:
+            self.counts[outcome] += 1
+            self.latencies.append(latency)
+
+
+def timed_move(service, request, outcomes):
+    """Makes one move and tallies it as ok, conflict or rejected"""
+    import endpoints
+    from google.appengine.ext import ndb
+
+    ndb.get_context().clear_cache()
+    start = time.time()
+    try:
+        service.make_move(request)
+        outcome = 'ok'
+    except endpoints.ConflictException:
+        outcome = 'conflict'
+    except endpoints.ServiceException:
+        outcome = 'rejected'
+    outcomes.add(outcome, time.time() - start)
+    return outcome
+
+
+def run_threads(count, target):
+    """Runs target(i) on count threads released at the same moment"""
+    start = threading.Event()
+
+    def wrapped(i):
+        start.wait()
+        target(i)
+
+    threads = [threading.Thread(target=wrapped, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    began = time.time()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return time.time() - began
+
+
+def check_game(game, ok_moves):
+    """Returns a list of the invariants a game breaks"""
+    import movelog
+
+    filled = sum(1 for cell in game.board_state if cell)
+    logged = len(movelog.unpack(game.move_log, game.board_size))
+    counted = game.user_moves + game.opponent_moves
+    errors = []
+    if not filled == logged == counted == ok_moves:
+        errors.append('{} cells filled, {} moves logged, {} moves counted, '
+                      '{} moves accepted'.format(filled, logged, counted,
+                                                 ok_moves))
+    for index, player in movelog.unpack(game.move_log, game.board_size):
+        if game.board_state[index] != player:
+            errors.append('cell {} does not hold the logged player'.format(
+                index + 1))
+            break
+    return errors
+
+
+def busy_game(service, api, args):
+    """Every thread plays its own cells of one shared game"""
+    form = service.new_game(api.NEW_GAME_REQUEST.combined_message_class(
+        user_name='alice', opponent_name='bob',
+        board_size=BUSY_BOARD_SIZE, win_length=BUSY_BOARD_SIZE))
+    cells = range(1, BUSY_BOARD_SIZE * BUSY_BOARD_SIZE + 1)[:args.moves]
+    outcomes = Outcomes()
+
+    def play(i):
+        player = 'alice' if i % 2 == 0 else 'bob'
+        for move in cells[i::args.threads]:
+            timed_move(service, api.MAKE_MOVE_REQUEST.combined_message_class(
+                urlsafe_game_key=form.urlsafe_key, player_name=player,
+                move=move), outcomes)
+
+    elapsed = run_threads(args.threads, play)
+    from google.appengine.ext import ndb
+    game = ndb.Key(urlsafe=form.urlsafe_key).get(use_cache=False,
+                                                 use_memcache=False)
+    errors = check_game(game, outcomes.counts['ok'])
+    return outcomes, elapsed, errors, game.key
+
+
+def cell_race(service, api, args):
+    """All threads try the same cell of a new game at once"""
+    outcomes, errors, elapsed = Outcomes(), [], 0.0
+    for round_number in range(args.rounds):
+        form = service.new_game(api.NEW_GAME_REQUEST.combined_message_class(
+            user_name='alice', opponent_name='bob'))
+        move = round_number % 9 + 1
+        results = []
+
+        def play(i):
+            results.append(timed_move(
+                service, api.MAKE_MOVE_REQUEST.combined_message_class(
+                    urlsafe_game_key=form.urlsafe_key,
+                    player_name='alice' if i % 2 == 0 else 'bob', move=move),
+                outcomes))
+
+        elapsed += run_threads(args.threads, play)
+        from google.appengine.ext import ndb
+        game = ndb.Key(urlsafe=form.urlsafe_key).get(use_cache=False,
+                                                     use_memcache=False)
+        winners = results.count('ok')
+        if winners != 1:
+            errors.append('round {}: {} threads filled cell {}'.format(
+                round_number, winners, move))
+        errors.extend('round {}: {}'.format(round_number, error)
+                      for error in check_game(game, winners))
+    return outcomes, elapsed, errors
+
+
+def report(name, outcomes, elapsed, errors):
+    latencies = outcomes.latencies
+    print '{}: {} requests in {:.2f}s, {:.1f} requests/s'.format(
+        name, len(latencies), elapsed, len(latencies) / elapsed)
+    print '  outcomes: {}'.format(', '.join(
+        '{} {}'.format(count, outcome)
+        for outcome, count in sorted(outcomes.counts.items())))
+    print '  latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+        percentile(latencies, 0.50) * 1e3, percentile(latencies, 0.95) * 1e3,
+        percentile(latencies, 0.99) * 1e3)
+    print '  invariants: {}'.format('; '.join(errors) if errors else 'ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--moves', type=int, default=200,
+                        help='moves made in the busy game')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='rounds of the cell race')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    bed = activate_testbed()
+    try:
+        import api
+        import contention
+        from api import TicTacToeApi
+
+        service = TicTacToeApi()
+        for name in ('alice', 'bob'):
+            service.create_user(api.USER_REQUEST.combined_message_class(
+                user_name=name))
+
+        outcomes, elapsed, errors, key = busy_game(service, api, args)
+        report('busy game', outcomes, elapsed, errors)
+        counts = contention.get_counts(key)
+        print '  conflicts {conflicts}, moves given up {failures}'.format(
+            **counts)
+
+        outcomes, elapsed, errors = cell_race(service, api, args)
+        report('cell race', outcomes, elapsed, errors)
+        print ('  total conflicts {conflicts}, moves given up '
+               '{failures}').format(**contention.get_counts())
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""board.py - Win detection engine for Tic Tac Toe boards.
+
+Boards are stored as the flat list of integers described in Design.txt
+(0 = empty, 1 = player one, 2 = player two). Two engines are provided:
+
+ - The classic 3x3 board is checked with bitboards: each player's cells are
+   packed into a 9-bit integer and compared against the 8 precomputed line
+   masks.
+ - Larger boards (e.g. 15x15 with five-in-a-row) only scan the four lines
+   running through the last placed cell, so a check costs O(win_length)
+   instead of O(board)."""
+
+DEFAULT_BOARD_SIZE = 3
+DEFAULT_WIN_LENGTH = 3
+MAX_BOARD_SIZE = 19
+
+# (row, column) steps for horizontal, vertical, diagonal and anti-diagonal
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+_line_masks = {}
+
+
+def line_masks(size, win_length):
+    """Returns the bitmasks of every winning line for the given board.
+    Masks are computed once per (size, win_length) and then cached."""
+    masks = _line_masks.get((size, win_length))
+    if masks is None:
+        masks = []
+        for row in range(size):
+            for col in range(size):
+                for d_row, d_col in DIRECTIONS:
+                    end_row = row + d_row * (win_length - 1)
+                    end_col = col + d_col * (win_length - 1)
+                    if not (0 <= end_row < size and 0 <= end_col < size):
+                        continue
+                    mask = 0
+                    for step in range(win_length):
+                        cell = (row + d_row * step) * size + col + d_col * step
+                        mask |= 1 << cell
+                    masks.append(mask)
+        masks = tuple(masks)
+        _line_masks[(size, win_length)] = masks
+    return masks
+
+
+def to_bitboard(board, player):
+    """Packs the cells owned by player into an integer bitboard"""
+    bits = 0
+    for i, cell in enumerate(board):
+        if cell == player:
+            bits |= 1 << i
+    return bits
+
+
+def has_line(bits, size=DEFAULT_BOARD_SIZE, win_length=DEFAULT_WIN_LENGTH):
+    """Returns True if the bitboard contains a complete winning line"""
+    for mask in line_masks(size, win_length):
+        if bits & mask == mask:
+            return True
+    return False
+
+
+def winner(board, size=DEFAULT_BOARD_SIZE, win_length=DEFAULT_WIN_LENGTH):
+    """Returns the player (1 or 2) owning a complete line, or 0.
+    Checks the whole board, so it is only meant for small boards."""
+    for player in (1, 2):
+        if has_line(to_bitboard(board, player), size, win_length):
+            return player
+    return 0
+
+
+def wins_at(board, index, size, win_length):
+    """Returns the player at index if one of the lines through index is a
+    win, or 0. Only the cells along the four directions are inspected."""
+    player = board[index]
+    if not player:
+        return 0
+    row, col = divmod(index, size)
+    for d_row, d_col in DIRECTIONS:
+        count = 1
+        for sign in (1, -1):
+            r, c = row + sign * d_row, col + sign * d_col
+            while (0 <= r < size and 0 <= c < size and
+                   board[r * size + c] == player):
+                count += 1
+                if count >= win_length:
+                    return player
+                r, c = r + sign * d_row, c + sign * d_col
+    return 0
+
+
+def check_winner(board, size=DEFAULT_BOARD_SIZE,
+                 win_length=DEFAULT_WIN_LENGTH, last_move=None):
+    """Returns the winning player (1 or 2) or 0 if there is no winner.
+    Uses the bitboard engine for the 3x3 board and the last-move scan for
+    larger boards. Without a last_move, larger boards fall back to scanning
+    every occupied cell."""
+    if size == DEFAULT_BOARD_SIZE and win_length == DEFAULT_WIN_LENGTH:
+        return winner(board, size, win_length)
+    if last_move is not None:
+        return wins_at(board, last_move, size, win_length)
+    for index in range(len(board)):
+        result = wins_at(board, index, size, win_length)
+        if result:
+            return result
+    return 0
+
+
+def is_valid_variant(size, win_length):
+    """Returns True if a board of this size and win length can be played"""
+    return (DEFAULT_BOARD_SIZE <= size <= MAX_BOARD_SIZE and
+            DEFAULT_WIN_LENGTH <= win_length <= size)
@@ -0,0 +1,41 @@
+"""contention.py - Counters of transaction conflicts on games.
+
+Moves are applied in a transaction on the game. When two requests change
+the same game at once, one of the commits fails and is retried after a
+short backoff, up to a bounded number of attempts. These counters show how
+often that happens, in total and for every game: moves applied, commit
+conflicts, and moves given up after the last attempt.
+
+Counts are buffered in-process and added to memcache every few seconds, so
+recording them costs no RPC on the move path."""
+
+from counters import BufferedCounters
+
+STATS_PREFIX = 'move_contention:'
+FIELDS = ('moves', 'conflicts', 'failures')
+TOTAL = 'total'
+
+_counters = BufferedCounters(STATS_PREFIX)
+
+
+def record(game_key, moves=0, conflicts=0, failures=0):
+    """Counts the outcome of one move request on a game"""
+    deltas = {}
+    for name in (TOTAL, game_key.urlsafe()):
+        deltas.update({'{}|moves'.format(name): moves,
+                       '{}|conflicts'.format(name): conflicts,
+                       '{}|failures'.format(name): failures})
+    _counters.add(deltas)
+
+
+def flush():
+    """Adds the buffered counts to the shared counters in memcache"""
+    _counters.flush()
+
+
+def get_counts(game_key=None):
+    """Returns the counters of one game, or the totals of all games"""
+    name = game_key.urlsafe() if game_key else TOTAL
+    keys = ['{}|{}'.format(name, field) for field in FIELDS]
+    shared = _counters.get_multi(keys)
+    return dict((field, shared[key]) for field, key in zip(FIELDS, keys))
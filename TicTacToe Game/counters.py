@@ -0,0 +1,54 @@
+"""counters.py - Counters buffered in-process and shared through memcache.
+
+Counts are added to an in-process buffer, so recording them costs no RPC on
+the request path. Every few seconds the buffer is added to counters in
+memcache with a single offset_multi, from where every instance can read
+them. Counts buffered by an instance that shuts down before its next flush
+are lost, so the counters are for monitoring only."""
+
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import memcache
+
+FLUSH_SECONDS = 10
+
+
+class BufferedCounters(object):
+    """Counters under a memcache key prefix, flushed every flush_seconds"""
+
+    def __init__(self, prefix, flush_seconds=FLUSH_SECONDS):
+        self.prefix = prefix
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._last_flush = time.time()
+
+    def add(self, deltas):
+        """Adds a dict of counts by name to the buffer, flushing it if the
+        last flush is flush_seconds ago"""
+        with self._lock:
+            for name, count in deltas.items():
+                if count:
+                    self._counts[name] += count
+            if time.time() - self._last_flush < self.flush_seconds:
+                return
+        self.flush()
+
+    def flush(self):
+        """Adds the buffered counts to the shared counters in memcache"""
+        with self._lock:
+            deltas = dict(self._counts)
+            self._counts.clear()
+            self._last_flush = time.time()
+        if deltas:
+            memcache.offset_multi(deltas, key_prefix=self.prefix,
+                                  initial_value=0)
+
+    def get_multi(self, names):
+        """Returns a dict mapping names to their shared counts, including
+        the buffer of this instance"""
+        self.flush()
+        shared = memcache.get_multi(names, key_prefix=self.prefix)
+        return dict((name, shared.get(name, 0)) for name in names)
@@ -0,0 +1,95 @@
+"""game_cache.py - Write-through memcache cache for Game entities.
+
+Entries are keyed by the urlsafe game key and hold (version, game), where
+version is Game.version. Every put of a Game stores the new version once it
+is committed, using compare-and-set so that a slower writer can never
+replace a newer entry with an older one. If the CAS keeps failing the entry
+is dropped and the next read goes to the datastore.
+
+Hit, miss, eviction and CAS conflict counts are buffered in-process and
+flushed to memcache every few seconds, so they can be read from any
+instance."""
+
+import sys
+
+from google.appengine.api import memcache
+
+from counters import BufferedCounters
+from utils import get_key_by_urlsafe, check_kind
+
+CACHE_PREFIX = 'game:'
+CACHE_SECONDS = 60 * 60
+CAS_RETRIES = 3
+# Version of the entry left behind by a deleted game. It is never replaced
+# by a stale write and reads of it return None.
+DELETED_VERSION = sys.maxint
+STATS_PREFIX = 'game_cache_stats:'
+STATS_FIELDS = ('hits', 'misses', 'evictions', 'cas_conflicts',
+                'invalidations')
+
+_stats = BufferedCounters(STATS_PREFIX)
+
+
+def _count(field, count=1):
+    _stats.add({field: count})
+
+
+def flush_stats():
+    """Adds the buffered counts to the shared counters in memcache"""
+    _stats.flush()
+
+
+def get_stats():
+    """Returns the shared counters, including this instance's buffer"""
+    return _stats.get_multi(STATS_FIELDS)
+
+
+def get_game(urlsafe, model):
+    """Returns the Game the urlsafe key points to, from memcache if it is
+    cached, or None if it does not exist. Raises a BadRequestException for
+    a malformed key and a ValueError for a key of another kind."""
+    cache_key = CACHE_PREFIX + urlsafe
+    cached = memcache.get(cache_key)
+    if cached is not None:
+        _count('hits')
+        return cached[1]
+    _count('misses')
+    game = check_kind(get_key_by_urlsafe(urlsafe).get(), model)
+    if game:
+        if game.version:
+            # The game was written through before, so the entry was evicted
+            _count('evictions')
+        memcache.add(cache_key, (game.version, game), time=CACHE_SECONDS)
+    return game
+
+
+def store(game):
+    """Writes a Game through to the cache unless a newer version of it is
+    already cached"""
+    client = memcache.Client()
+    cache_key = CACHE_PREFIX + game.key.urlsafe()
+    for _ in range(CAS_RETRIES):
+        cached = client.gets(cache_key)
+        if cached is None:
+            if client.add(cache_key, (game.version, game),
+                          time=CACHE_SECONDS):
+                return
+        elif cached[0] >= game.version:
+            return
+        elif client.cas(cache_key, (game.version, game), time=CACHE_SECONDS):
+            return
+        _count('cas_conflicts')
+    invalidate(game.key)
+
+
+def invalidate(key):
+    """Drops a Game from the cache"""
+    _count('invalidations')
+    memcache.delete(CACHE_PREFIX + key.urlsafe())
+
+
+def remove(key):
+    """Marks a deleted Game in the cache, so a concurrent read that fetched
+    it before the delete can not put it back"""
+    memcache.set(CACHE_PREFIX + key.urlsafe(), (DELETED_VERSION, None),
+                 time=CACHE_SECONDS)
@@ -0,0 +1,145 @@
+"""instrumentation.py - Lightweight per-endpoint timing and RPC counters.
+
+Endpoint methods are wrapped with the instrumented decorator and the main
+WSGI application with InstrumentedApp. For a sampled request they record
+the wall time, the datastore gets, puts and queries, memcache hits and
+misses and the response size. Every request is counted, sampled or not.
+
+The RPCs are counted by apiproxy hooks that only do work while a sampled
+request is running on the current thread. Totals are kept in-process and
+added to counters in memcache every few seconds, from where get_stats reads
+them for every instance."""
+
+import functools
+import random
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import protojson
+
+from counters import BufferedCounters
+
+SAMPLE_RATE = 0.1
+STATS_PREFIX = 'endpoint_stats:'
+FIELDS = ('calls', 'sampled', 'wall_us', 'datastore_get', 'datastore_put',
+          'datastore_query', 'memcache_hits', 'memcache_misses',
+          'response_bytes')
+DATASTORE_CALLS = {'Get': 'datastore_get', 'Put': 'datastore_put',
+                   'RunQuery': 'datastore_query'}
+
+_local = threading.local()
+_totals = BufferedCounters(STATS_PREFIX)
+_names = set()
+
+
+def _pre_call_hook(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is not None and service == 'datastore_v3' \
+            and call in DATASTORE_CALLS:
+        counts[DATASTORE_CALLS[call]] += 1
+
+
+def _post_call_hook(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is not None and service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['memcache_hits'] += hits
+        counts['memcache_misses'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'instrumentation', _pre_call_hook)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _post_call_hook)
+
+
+def register(name):
+    """Adds a name to the ones reported by get_stats"""
+    _names.add(name)
+
+
+def _start():
+    """Starts counting RPCs on this thread if the request is sampled.
+    Returns the start time, or None if the request is not sampled."""
+    if random.random() >= SAMPLE_RATE:
+        return None
+    _local.counts = defaultdict(int)
+    return time.time()
+
+
+def _finish(name, started, response_bytes=None):
+    """Adds a finished request to the in-process totals"""
+    counts = {'calls': 1}
+    if started is not None:
+        counts.update(_local.counts)
+        _local.counts = None
+        counts['sampled'] = 1
+        counts['wall_us'] = int((time.time() - started) * 1e6)
+        counts['response_bytes'] = response_bytes() if response_bytes else 0
+    _totals.add(dict(('{}|{}'.format(name, field), count)
+                     for field, count in counts.items()))
+
+
+def instrumented(method):
+    """Decorator recording the calls of an endpoints method. Apply it below
+    the endpoints.method decorator."""
+    name = method.__name__
+    register(name)
+
+    @functools.wraps(method)
+    def wrapper(service, request):
+        started = _start()
+        response = None
+        try:
+            response = method(service, request)
+            return response
+        finally:
+            _finish(name, started, None if response is None else (
+                lambda: len(protojson.encode_message(response))))
+    return wrapper
+
+
+class InstrumentedApp(object):
+    """WSGI middleware recording the requests of a webapp2 application by
+    path"""
+
+    def __init__(self, app, paths=()):
+        self.app = app
+        for path in paths:
+            register(path)
+
+    def __call__(self, environ, start_response):
+        name = environ.get('PATH_INFO', '')
+        started = _start()
+        body = []
+        try:
+            body = list(self.app(environ, start_response))
+            return body
+        finally:
+            _finish(name, started,
+                    lambda: sum(len(chunk) for chunk in body))
+
+
+def flush():
+    """Adds the in-process totals to the shared counters in memcache"""
+    _totals.flush()
+
+
+def get_stats(names=None):
+    """Returns a dict mapping each endpoint or path to its totals and the
+    averages per sampled call"""
+    names = sorted(names or _names)
+    keys = ['{}|{}'.format(name, field) for name in names for field in FIELDS]
+    shared = _totals.get_multi(keys)
+    stats = {}
+    for name in names:
+        totals = dict((field, shared['{}|{}'.format(name, field)])
+                      for field in FIELDS)
+        sampled = totals['sampled']
+        averages = dict((field, float(totals[field]) / sampled if sampled
+                         else 0.0)
+                        for field in FIELDS[2:])
+        stats[name] = {'totals': totals, 'per_sampled_call': averages}
+    return stats
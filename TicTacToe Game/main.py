@@ -3,22 +3,102 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import hashlib
+import json
+import time
+from datetime import date
+
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import TicTacToeApi
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import (User, Game, remap_user_references, count_games,
+                    migrate_moves_histories, rate_unrated_users)
+import archive
+import board
+import instrumentation
+import matchmaking
+import ratings
+import stats
 
-from models import User
-from models import Game
+# Active games read per scan task and users mailed per send task
+SCAN_BATCH_SIZE = 1000
+MAIL_BATCH_SIZE = 100
+# taskqueue.Queue.add accepts at most this many tasks per call
+MAX_TASKS_PER_ADD = 100
+REMINDED_PREFIX = 'reminded:{}:'
+REMINDED_SECONDS = 24 * 60 * 60
+MIGRATION_BATCH_SIZE = 200
+# Time a user key migration task spends moving references
+MIGRATION_TASK_SECONDS = 5 * 60
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start scanning for Users with active games to remind.
+        Called every day using a cron job"""
+        taskqueue.add(url='/tasks/scan_reminders',
+                      params={'run': date.today().isoformat()})
+
+
+class ScanReminders(webapp2.RequestHandler):
+    def post(self):
+        """Collect the players of one batch of active games and fan the
+        reminder emails out to send tasks. Continues with the next batch in
+        a new task, so an interrupted scan resumes from its cursor. Tasks
+        are named after the run and the cursor of the batch, so a retried
+        scan task does not add them twice."""
+        run = self.request.get('run')
+        urlsafe_cursor = self.request.get('cursor')
+        player_keys, next_cursor, more = Game.fetch_active_player_keys(
+            SCAN_BATCH_SIZE, Cursor(urlsafe=urlsafe_cursor or None))
+
+        batch = hashlib.md5(urlsafe_cursor).hexdigest()
+        to_remind = sorted(key.urlsafe() for key in player_keys)
+        tasks = [taskqueue.Task(
+                     url='/tasks/send_reminders',
+                     name='send-reminders-{}-{}-{}'.format(run, batch, i),
+                     params={'run': run, 'user_keys': ','.join(
+                         to_remind[i:i + MAIL_BATCH_SIZE])})
+                 for i in range(0, len(to_remind), MAIL_BATCH_SIZE)]
+        if more and next_cursor:
+            next_batch = hashlib.md5(next_cursor.urlsafe()).hexdigest()
+            tasks.append(taskqueue.Task(
+                url='/tasks/scan_reminders',
+                name='scan-reminders-{}-{}'.format(run, next_batch),
+                params={'run': run, 'cursor': next_cursor.urlsafe()}))
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+            try:
+                queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                # Added by an earlier attempt; the other tasks are added
+                pass
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send a reminder email to each of a batch of Users with an email.
+        A player with games in several batches is only reminded once a run:
+        players are marked in memcache once mailed. If memcache is down
+        nobody is marked, so a player may get a second mail but never
+        none."""
+        # Only loaded by the instances sending the mails
+        from google.appengine.api import app_identity, mail
         app_id = app_identity.get_application_id()
-        users = User.fetch_users_with_active_games()
-        
-        for user in users:
+        prefix = REMINDED_PREFIX.format(self.request.get('run'))
+        urlsafes = [urlsafe
+                    for urlsafe in self.request.get('user_keys').split(',')
+                    if urlsafe]
+        reminded = memcache.get_multi(urlsafes, key_prefix=prefix)
+        urlsafes = [urlsafe for urlsafe in urlsafes if urlsafe not in reminded]
+        users = ndb.get_multi([ndb.Key(urlsafe=urlsafe)
+                               for urlsafe in urlsafes])
+        for urlsafe, user in zip(urlsafes, users):
+            if not user or not user.email:
+                continue
             subject = 'This is a reminder that you have an active game!'
             body = 'Hello {}, go become a champion in Tic Tac Toe!'.format(user.name)
             # This will send test emails, the arguments to send_mail are:
@@ -27,16 +107,174 @@ class SendReminderEmail(webapp2.RequestHandler):
                            user.email,
                            subject,
                            body)
+            memcache.set(prefix + urlsafe, True, time=REMINDED_SECONDS)
+
+
+class MigrateMoveHistory(webapp2.RequestHandler):
+    def get(self):
+        """Start converting Game.moves_history into packed move logs"""
+        taskqueue.add(url='/tasks/migrate_move_history')
+
+    def post(self):
+        """Convert one batch of games and continue with the next batch in a
+        new task, so the migration can resume from its cursor."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        migrate_moves_histories(games)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_move_history',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class BackfillRatings(webapp2.RequestHandler):
+    def get(self):
+        """Start giving Users created before ratings the initial rating"""
+        taskqueue.add(url='/tasks/backfill_ratings')
 
+    def post(self):
+        """Rate and count one batch of unrated Users in the rank index and
+        continue with the next batch in a new task"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        rate_unrated_users(users)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_ratings',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class BuildRankIndex(webapp2.RequestHandler):
+    def get(self):
+        """Start counting the users in the fine buckets of the rank index"""
+        taskqueue.add(url='/tasks/build_rank_index')
 
-class UpdateAverageMoves(webapp2.RequestHandler):
     def post(self):
-        """Update game listing announcement in memcache."""
-        TicTacToeApi._cache_average_moves()
-        self.response.set_status(204)
+        """Count the users of every fine rating bucket with a query and
+        store the counts as the base of the fine buckets"""
+        futures = [User.query(User.rating >= lower, User.rating < upper)
+                   .count_async(keys_only=True)
+                   for lower, upper in ratings.fine_bucket_bounds()]
+        ratings.set_fine_base([future.get_result() for future in futures])
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Users with numeric ids to the key of their name"""
+        taskqueue.add(url='/tasks/migrate_user_keys')
+
+    def post(self):
+        """Move one batch of Users and continue in a new task. Each User is
+        first copied to its new key, which name lookups find from then on,
+        then its Games, Scores and MatchTickets are pointed to the copy and
+        finally the User is deleted. A User whose references are not all
+        moved within MIGRATION_TASK_SECONDS is picked up again by the next
+        task, so the migration can always resume."""
+        deadline = time.time() + MIGRATION_TASK_SECONDS
+        # Numeric ids sort before names, so the Users left to move come first
+        users = [user for user in User.query().order(User.key).fetch(
+                     MIGRATION_BATCH_SIZE)
+                 if isinstance(user.key.id(), (int, long))]
+        for user in users:
+            new_key = user.copy_to_name_key()
+            moved = False
+            while not moved and time.time() < deadline:
+                moved = remap_user_references(user.key, new_key,
+                                              MIGRATION_BATCH_SIZE)
+            if not moved:
+                break
+            user.migrate_key()
+        if users:
+            taskqueue.add(url='/tasks/migrate_user_keys')
+
+
+class RecountStats(webapp2.RequestHandler):
+    def get(self):
+        """Start counting the games created before the running statistics"""
+        taskqueue.add(url='/tasks/recount_stats')
+
+    def post(self):
+        """Count one batch of games in the running statistics and continue
+        with the next batch in a new task, so the recount can resume from
+        its cursor. Games counted already are skipped, so it can also be
+        restarted from the beginning."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        count_games(keys)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/recount_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class PairPlayers(webapp2.RequestHandler):
+    def post(self):
+        """Pair the players waiting for a match. Continues from the cursors
+        of every shard in a new task while more players are waiting than
+        one task reads."""
+        cursors = self.request.get('cursors')
+        if cursors:
+            cursors = dict((int(shard), cursor) for shard, cursor
+                           in json.loads(cursors).items())
+        cursors = matchmaking.run_pairing(cursors or None)
+        if cursors:
+            taskqueue.add(url=matchmaking.PAIRING_URL,
+                          params={'cursors': json.dumps(cursors)})
+
+
+class CompactGames(webapp2.RequestHandler):
+    def get(self):
+        """Start moving games finished some days ago into archive records.
+        Called every day using a cron job"""
+        taskqueue.add(url='/tasks/compact_games')
+
+    def post(self):
+        """Archive one batch of games finished some days ago and continue
+        with the next batch in a new task until none are left"""
+        if archive.compact_batch() == archive.ARCHIVE_BATCH_SIZE:
+            taskqueue.add(url='/tasks/compact_games')
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the hot paths of a new instance before it serves user
+        requests. Called by App Engine when a new instance starts."""
+        # Importing the API builds the endpoints server and loads the models
+        import api
+        import solver
+        solver.get_table()
+        board.line_masks(board.DEFAULT_BOARD_SIZE, board.DEFAULT_WIN_LENGTH)
+        # The first datastore and memcache calls set up their connections
+        stats.get_totals()
+        self.response.write('ok')
+
+
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the instrumentation counters of every endpoint and
+        handler as JSON"""
+        # Importing the API registers the names of its endpoints
+        import api
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.get_stats(),
+                                       indent=2, sort_keys=True))
 
 
-app = webapp2.WSGIApplication([
+routes = [
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_moves', UpdateAverageMoves),
-], debug=True)
+    ('/tasks/scan_reminders', ScanReminders),
+    ('/tasks/send_reminders', SendReminders),
+    ('/tasks/migrate_move_history', MigrateMoveHistory),
+    ('/tasks/backfill_ratings', BackfillRatings),
+    ('/tasks/build_rank_index', BuildRankIndex),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/recount_stats', RecountStats),
+    ('/tasks/pair_players', PairPlayers),
+    ('/crons/compact_games', CompactGames),
+    ('/tasks/compact_games', CompactGames),
+    ('/admin/stats', EndpointStats),
+]
+app = instrumentation.InstrumentedApp(
+    webapp2.WSGIApplication(routes, debug=True),
+    paths=[path for path, handler in routes])
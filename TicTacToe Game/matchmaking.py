@@ -0,0 +1,209 @@
+"""matchmaking.py - Server side queue pairing players into new games.
+
+A player joins the queue with a MatchTicket keyed by their name, optionally
+limiting the rating difference to the opponent. Tickets are root entities,
+so enqueues never contend with each other, and each ticket is written to
+one of a fixed number of shards so the index the pairing worker reads is
+not a single hot range of timestamps.
+
+Enqueues fan in to one named pairing task per few seconds. The task pages
+through the waiting tickets of every shard, oldest first, pairs them
+greedily in rating order together with the tickets left unpaired on
+earlier pages and creates each game through Game.new_game in a cross-group
+transaction that also marks both tickets, so a ticket is never matched
+twice. Queue depth and time to match are kept in the sharded counters of
+stats."""
+
+import random
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, MatchTicketForm
+import ratings
+import stats
+
+NUM_SHARDS = 20
+# Waiting tickets read from each shard per page, and pages per pairing task
+BATCH_PER_SHARD = 25
+PAGES_PER_TASK = 10
+PAIRING_URL = '/tasks/pair_players'
+PAIRING_SECONDS = 2
+SCHEDULED_PREFIX = 'pairing_scheduled:'
+
+
+class MatchTicket(ndb.Model):
+    """A player waiting for an opponent, keyed by the user name"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    shard = ndb.IntegerProperty(required=True)
+    rating = ndb.FloatProperty(required=True, indexed=False)
+    max_rating_diff = ndb.IntegerProperty(indexed=False)
+    created = ndb.DateTimeProperty(required=True)
+    # Set once the player is matched
+    game = ndb.KeyProperty(kind='Game')
+    matched = ndb.DateTimeProperty(indexed=False)
+
+    def to_form(self):
+        """Returns a MatchTicketForm representation of the MatchTicket"""
+        return MatchTicketForm(
+            user_name=self.key.id(), matched=self.game is not None,
+            urlsafe_game_key=self.game.urlsafe() if self.game else None,
+            wait_seconds=self.wait_seconds())
+
+    def wait_seconds(self):
+        """Returns the time waited until the match, or until now"""
+        end = self.matched or datetime.now()
+        return (end - self.created).total_seconds()
+
+    def accepts(self, other):
+        """Returns True if the rating of another ticket is within range"""
+        return (self.max_rating_diff is None or
+                abs(self.rating - other.rating) <= self.max_rating_diff)
+
+
+@ndb.transactional
+def _enqueue(user, max_rating_diff):
+    ticket = MatchTicket.get_by_id(user.name)
+    if ticket and not ticket.game:
+        ticket.max_rating_diff = max_rating_diff
+        ticket.put()
+        return ticket, False
+    ticket = MatchTicket(
+        id=user.name, user=user.key,
+        shard=random.randint(0, NUM_SHARDS - 1),
+        rating=ratings.INITIAL_RATING if user.rating is None else user.rating,
+        max_rating_diff=max_rating_diff, created=datetime.now())
+    ticket.put()
+    return ticket, True
+
+
+def enqueue(user, max_rating_diff=None):
+    """Puts a User in the queue, or updates the rating range of a User
+    already waiting. Returns the MatchTicket."""
+    ticket, added = _enqueue(user, max_rating_diff)
+    if added:
+        stats.record(queued_players=1)
+    schedule_pairing()
+    return ticket
+
+
+@ndb.transactional
+def _leave(name):
+    ticket = MatchTicket.get_by_id(name)
+    if not ticket or ticket.game:
+        return False
+    ticket.key.delete()
+    return True
+
+
+def leave(name):
+    """Takes a waiting User out of the queue. Returns False if the User was
+    not waiting."""
+    left = _leave(name)
+    if left:
+        stats.record(queued_players=-1)
+    return left
+
+
+def schedule_pairing():
+    """Makes sure a pairing task runs within PAIRING_SECONDS. All enqueues
+    in the same interval share one named task; memcache saves most of them
+    the taskqueue call."""
+    slot = int(time.time() // PAIRING_SECONDS)
+    if not memcache.add(SCHEDULED_PREFIX + str(slot), True,
+                        time=PAIRING_SECONDS * 2):
+        return
+    # Loaded here, so the API does not load the taskqueue on start up
+    from google.appengine.api import taskqueue
+    try:
+        taskqueue.add(url=PAIRING_URL, name='pair-players-{}'.format(slot),
+                      countdown=PAIRING_SECONDS)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def fetch_waiting(cursors=None):
+    """Returns (tickets, cursors) with the next page of waiting tickets of
+    every shard, oldest first, read in parallel. cursors maps each shard
+    still to read to the urlsafe cursor to continue from; None starts all
+    shards from the oldest ticket. The returned cursors only hold the
+    shards that may have more tickets."""
+    if cursors is None:
+        cursors = dict.fromkeys(range(NUM_SHARDS))
+    futures = dict(
+        (shard, MatchTicket.query(MatchTicket.shard == shard,
+                                  MatchTicket.game == None)
+         .order(MatchTicket.created).fetch_page_async(
+             BATCH_PER_SHARD, start_cursor=Cursor(urlsafe=cursor)))
+        for shard, cursor in cursors.items())
+    tickets, next_cursors = [], {}
+    for shard, future in futures.items():
+        batch, cursor, more = future.get_result()
+        tickets.extend(batch)
+        if more and cursor:
+            next_cursors[shard] = cursor.urlsafe()
+    return tickets, next_cursors
+
+
+def pair(tickets):
+    """Returns a list of (first, second) ticket pairs. Tickets are sorted
+    by rating and neighbours are paired when both accept the other's
+    rating; the ticket waiting longer plays first."""
+    ordered = sorted(tickets, key=lambda ticket: ticket.rating)
+    pairs, i = [], 0
+    while i < len(ordered) - 1:
+        first, second = ordered[i], ordered[i + 1]
+        if first.accepts(second) and second.accepts(first):
+            pairs.append(sorted((first, second),
+                                key=lambda ticket: ticket.created))
+            i += 2
+        else:
+            i += 1
+    return pairs
+
+
+@ndb.transactional(xg=True)
+def _match(first_key, second_key):
+    first, second = ndb.get_multi([first_key, second_key])
+    if not first or not second or first.game or second.game:
+        return None
+    # Counted in the statistics by run_pairing once committed
+    game = Game.new_game(first.user, second.user, record_stats=False)
+    now = datetime.now()
+    for ticket in (first, second):
+        ticket.game = game.key
+        ticket.matched = now
+    ndb.put_multi([first, second])
+    return first.wait_seconds() + second.wait_seconds()
+
+
+def run_pairing(cursors=None):
+    """Pairs the waiting players page by page, for at most
+    PAGES_PER_TASK pages. Tickets left unpaired stay candidates for the
+    tickets of later pages, so players at the head of the queue that can
+    not be paired do not block the players behind them. Returns the
+    cursors to continue from in a new task, or None once every shard has
+    been read."""
+    pool, matched, wait_seconds = [], 0, 0.0
+    for _ in range(PAGES_PER_TASK):
+        tickets, cursors = fetch_waiting(cursors)
+        pool.extend(tickets)
+        done = set()
+        for first, second in pair(pool):
+            # Both leave the pool, also if another task matched one of them
+            done.update((first.key, second.key))
+            waited = _match(first.key, second.key)
+            if waited is not None:
+                matched += 2
+                wait_seconds += waited
+        pool = [ticket for ticket in pool if ticket.key not in done]
+        if not cursors:
+            break
+    if matched:
+        stats.record(active_games=matched // 2, queued_players=-matched,
+                     matched_players=matched,
+                     match_wait_ms=int(wait_seconds * 1000))
+    return cursors or None
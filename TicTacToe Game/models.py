@@ -1,10 +1,36 @@
 """models.py - contains the class definitions for the Datastore
 entities used by the Tic Tac Toe."""
 
-from datetime import date
+import re
+from datetime import date, datetime
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import board
+import game_cache
+import movelog
+import ratings
+import stats
+
+COMPUTER_NAME = 'computer'
+# Users are keyed by their name. Users created before that have numeric ids
+# and are found by a name query until /tasks/migrate_user_keys has moved
+# them; set this to False once the migration has finished.
+LEGACY_USER_LOOKUP = True
+# Format of the deprecated Game.moves_history entries
+MOVES_HISTORY_ENTRY = re.compile(r'^Player: (.*), Move: (-?\d+), Status: ')
+
+
+def fetch_user_names(keys):
+    """Returns a dict mapping each User key to its name. All keys are
+    resolved with a single get_multi, so building a page of forms costs one
+    round trip no matter how many rows reference a user."""
+    unique_keys = list(set(keys))
+    users = ndb.get_multi(unique_keys)
+    return dict((key, user.name) for key, user in zip(unique_keys, users)
+                if user)
+
+
 class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
@@ -12,25 +38,180 @@ class User(ndb.Model):
     games_won = ndb.IntegerProperty(default=0)
     games_lost = ndb.IntegerProperty(default=0)
     performance = ndb.FloatProperty(default=0.0)
+    # Elo rating, None until the user is counted in the rank index
+    rating = ndb.FloatProperty()
+    # Numeric key of a User copied to its name key by copy_to_name_key,
+    # until migrate_key has moved its references and deleted it
+    legacy_key = ndb.KeyProperty(kind='User', indexed=False)
 
-    def to_rank_form(self):
+    def to_rank_form(self, rank=None):
         """Returns a UserRanking representation of the User"""
         form = UserRankingForm()
         form.user_name = self.name
         form.performance = self.performance
+        form.rating = self.rating
+        form.rank = rank
         return form
 
     @classmethod
-    def fetch_users_with_active_games(cls):
-        users, users_with_active_games = User.query(), []
-        for user in users:
-            # User can be both user and opponent in a game
-            user_active_games = Game.query(ndb.OR(Game.user == user.key, Game.opponent == user.key))
-            # Filter only games that are active
-            user_game_count = user_active_games.filter(Game.game_over == False).count()
-            if user_game_count != 0:
-                users_with_active_games.append(user)
-        return users_with_active_games
+    def create(cls, name, email=None):
+        """Creates a User keyed by its name with the initial rating and
+        counts it in the rank index. Returns None if the name is taken."""
+        if LEGACY_USER_LOOKUP and cls.query(cls.name == name).get(
+                keys_only=True):
+            return None
+        user = cls._insert(cls(id=name, name=name, email=email,
+                               rating=ratings.INITIAL_RATING))
+        if user:
+            ratings.move_async(None, user.rating).get_result()
+        return user
+
+    @staticmethod
+    @ndb.transactional
+    def _insert(user):
+        """Puts a new User unless its key is already taken"""
+        if user.key.get():
+            return None
+        user.put()
+        return user
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns the User with a name, or None"""
+        user = yield ndb.Key(cls, name).get_async()
+        if not user and LEGACY_USER_LOOKUP:
+            user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with a name, or None"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    def get_by_names(cls, names):
+        """Returns a dict mapping names to Users for a batch of names, read
+        with a single get_multi. Unknown names are left out."""
+        names = list(set(names))
+        users = ndb.get_multi([ndb.Key(cls, name) for name in names])
+        found = dict((name, user) for name, user in zip(names, users) if user)
+        if LEGACY_USER_LOOKUP:
+            futures = [(name, cls.query(cls.name == name).get_async())
+                       for name in names if name not in found]
+            for name, future in futures:
+                user = future.get_result()
+                if user:
+                    found[name] = user
+        return found
+
+    def copy_to_name_key(self):
+        """First step of moving a User with a numeric id to the key of its
+        name: copies it there in a cross-group transaction, so name lookups
+        find the copy from then on. An unrated User is rated in the same
+        transaction. If another User already has that key it is left as it
+        is; migrate_key merges the two. Returns the new key."""
+        new_key = ndb.Key(User, self.name)
+
+        @ndb.transactional(xg=True)
+        def copy():
+            user, existing = ndb.get_multi([self.key, new_key])
+            if not user or existing:
+                return False
+            rated = user.rating is None and user.name != COMPUTER_NAME
+            if rated:
+                user.rating = ratings.INITIAL_RATING
+                user.put()
+            values = user.to_dict()
+            values['legacy_key'] = user.key
+            User(key=new_key, **values).put()
+            return rated
+
+        if copy():
+            ratings.move_async(None, ratings.INITIAL_RATING).get_result()
+        return new_key
+
+    def migrate_key(self):
+        """Last step of moving a User with a numeric id to the key of its
+        name, once its references have been moved to the new key: deletes
+        it in a cross-group transaction. If the User at the new key is not
+        its copy, the won and lost games are added to that User instead
+        and this one is dropped from the rank index."""
+        new_key = ndb.Key(User, self.name)
+
+        @ndb.transactional(xg=True)
+        def move():
+            user, existing = ndb.get_multi([self.key, new_key])
+            if not user:
+                return None
+            if not existing:
+                User(key=new_key, **user.to_dict()).put()
+            elif existing.legacy_key == user.key:
+                existing.legacy_key = None
+                existing.put()
+            else:
+                existing.games_won += user.games_won
+                existing.games_lost += user.games_lost
+                if existing.games_lost != 0:
+                    existing.performance = (float(existing.games_won) /
+                                            existing.games_lost)
+                existing.put()
+                user.key.delete()
+                return user.rating
+            user.key.delete()
+            return None
+
+        dropped_rating = move()
+        if dropped_rating is not None:
+            ratings.move_async(None, dropped_rating, count=-1).get_result()
+
+    def add_result(self, score):
+        """Counts a won (score 1), lost (0) or drawn (0.5) game"""
+        if score == 1:
+            self.games_won += 1
+        elif score == 0:
+            self.games_lost += 1
+        if self.games_lost != 0:
+            self.performance = float(self.games_won) / self.games_lost
+
+    @classmethod
+    def get_rank(cls, rating):
+        """Returns the rank of a rating: one more than the number of users
+        rated higher. Whole buckets above it are read from the rank index,
+        only users in its own bucket are counted with a query."""
+        higher, upper = ratings.count_above(rating)
+        query = User.query(User.rating > rating)
+        if upper is not None:
+            query = query.filter(User.rating < upper)
+        return higher + query.count(keys_only=True) + 1
+
+    @classmethod
+    def get_computer(cls):
+        """Returns the User playing single player games, creating it on
+        first use. The computer plays at ratings.COMPUTER_RATING, so it has
+        no rating of its own and is not counted in the rank index."""
+        computer = cls.get_by_name(COMPUTER_NAME)
+        if not computer:
+            return (cls._insert(cls(id=COMPUTER_NAME, name=COMPUTER_NAME)) or
+                    ndb.Key(cls, COMPUTER_NAME).get())
+        if computer.rating is not None:
+            # Created with a rating, before the computer was left unrated
+            rating = cls._unrate(computer.key)
+            if rating is not None:
+                ratings.move_async(None, rating, count=-1).get_result()
+            computer.rating = None
+        return computer
+
+    @staticmethod
+    @ndb.transactional
+    def _unrate(key):
+        """Removes the rating of a User, returning the old rating"""
+        user = key.get()
+        rating = user.rating
+        if rating is not None:
+            user.rating = None
+            user.put()
+        return rating
 
 
 class Game(ndb.Model):
@@ -41,81 +222,234 @@ class Game(ndb.Model):
     board_state = ndb.IntegerProperty(repeated=True)
     user_moves = ndb.IntegerProperty(required=True, default=0)
     opponent_moves = ndb.IntegerProperty(required=True, default=0)
+    move_log = ndb.BlobProperty(default='')
+    # Deprecated: moves as formatted strings, converted to move_log by
+    # the /tasks/migrate_move_history task
     moves_history = ndb.StringProperty(repeated=True)
+    board_size = ndb.IntegerProperty(default=board.DEFAULT_BOARD_SIZE)
+    win_length = ndb.IntegerProperty(default=board.DEFAULT_WIN_LENGTH)
+    single_player = ndb.BooleanProperty(default=False)
+    # Incremented on every put, used to version cached copies of the game
+    version = ndb.IntegerProperty(default=0)
+    # False for games created before the running statistics, until their
+    # first move or /tasks/recount_stats counts them
+    counted = ndb.BooleanProperty(default=False, indexed=False)
+    # When the game ended; finished games are archived some days later
+    finished = ndb.DateTimeProperty()
 
     @classmethod
-    def new_game(cls, user, opponent):
-        """Creates and returns a new game"""
-        game = Game(user=user, opponent=opponent, board_state=[0 for i in range(9)])
+    def new_game(cls, user, opponent, board_size=board.DEFAULT_BOARD_SIZE,
+                 win_length=board.DEFAULT_WIN_LENGTH, single_player=False,
+                 record_stats=True):
+        """Creates and returns a new game. Inside a transaction that may be
+        retried, pass record_stats=False and record active_games once it
+        is committed."""
+        game = Game(user=user, opponent=opponent,
+                    board_size=board_size, win_length=win_length,
+                    single_player=single_player, counted=True,
+                    board_state=[0 for i in range(board_size * board_size)])
         game.put()
+        if record_stats:
+            stats.record(active_games=1)
         return game
 
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        """Writes the game through to the cache once the put is committed"""
+        if future.get_exception() is None:
+            ndb.get_context().call_on_commit(lambda: game_cache.store(self))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if future.get_exception() is None:
+            ndb.get_context().call_on_commit(lambda: game_cache.remove(key))
+
+    @classmethod
+    def fetch_active_player_keys(cls, batch_size, cursor=None):
+        """Returns (player_keys, next_cursor, more) for one batch of active
+        games. Only the user and opponent properties are read, through a
+        projection query, and the player keys are de-duplicated."""
+        games, next_cursor, more = Game.query(
+            Game.game_over == False,
+            projection=[Game.user, Game.opponent]).fetch_page(
+                batch_size, start_cursor=cursor)
+        player_keys = set()
+        for game in games:
+            player_keys.add(game.user)
+            player_keys.add(game.opponent)
+        return list(player_keys), next_cursor, more
+
     @classmethod
     def fetch_active_games(cls, user):
+        if user.legacy_key:
+            # Games not yet moved to the name key of the user
+            return Game.query(Game.user.IN([user.key, user.legacy_key]),
+                              Game.game_over == False)
         return Game.query(Game.user == user.key, Game.game_over == False)
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def follow_moved_users(self, users):
+        """Points the game to the name keys of players copied there by the
+        user key migration, instead of their numeric keys"""
+        for user in users:
+            if user.legacy_key is None:
+                continue
+            if self.user == user.legacy_key:
+                self.user = user.key
+            if self.opponent == user.legacy_key:
+                self.opponent = user.key
+
+    @classmethod
+    def to_forms(cls, games, message):
+        """Returns GameForms for a list of games, resolving the players of
+        every game in one batch"""
+        names = fetch_user_names(
+            [key for game in games for key in (game.user, game.opponent)])
+        return [game.to_form(message, names) for game in games]
+
+    def to_form(self, message, names=None):
+        """Returns a GameForm representation of the Game. names maps User
+        keys to names; it is fetched when not given."""
+        if names is None:
+            names = fetch_user_names([self.user, self.opponent])
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
-        form.opponent_name = self.opponent.get().name
+        form.user_name = names.get(self.user)
+        form.opponent_name = names.get(self.opponent)
         form.board_state = self.board_state
+        form.board_size = self.board_size
+        form.win_length = self.win_length
         form.game_over = self.game_over
         form.user_moves = self.user_moves
         form.opponent_moves = self.opponent_moves
+        form.version = self.version
         form.message = message
         return form
 
-    def end_game(self, won=False):
-        """Ends the game - if won is True, the user won. - if won is False,
-        the player lost and the opponent won the game."""
+    def to_not_modified_form(self):
+        """Returns a GameForm telling the client its copy is up to date"""
+        return GameForm(urlsafe_key=self.key.urlsafe(), version=self.version,
+                        not_modified=True, message='Not modified')
+
+    @ndb.transactional_tasklet(xg=True)
+    def finish_async(self, won=False, draw=False):
+        """Marks the game over and updates the won and lost counts and the
+        ratings of the players, writing the game and the players together.
+        Joins the current transaction if there is one. Returns the (old,
+        new) rating of each player for record_result_async.
+        The computer plays every single player game, so it is left out of
+        the transaction; it is rated at ratings.COMPUTER_RATING and its
+        results are counted in the running statistics instead."""
+        if(draw):
+            won = False
         self.game_over = True
-        self.put()
-
-        # Update scores of both players
-        user = self.user.get()
-        opponent = self.opponent.get()
-        if(won):
-            user.games_won += 1
-            opponent.games_lost += 1
-        else:
-            user.games_lost += 1
-            opponent.games_won += 1
-        if(user.games_lost != 0):
-            user.performance = float(user.games_won) / user.games_lost
-        if(opponent.games_lost != 0):
-            opponent.performance = float(opponent.games_won) / opponent.games_lost
-        user.put()
-        opponent.put()
+        self.finished = datetime.now()
+        user_score = 0.5 if draw else float(won)
+        # Update scores and ratings of both players
+        keys = [self.user] if self.single_player else [self.user,
+                                                       self.opponent]
+        players = yield ndb.get_multi_async(keys)
+        if LEGACY_USER_LOOKUP:
+            # Players copied to their name key are updated there
+            players = yield [_moved_user_async(player) for player in players]
+            self.follow_moved_users(players)
+        user = players[0]
+        opponent = players[1] if len(players) > 1 else None
+        user.add_result(user_score)
+        old_ratings = [player.rating for player in players]
+        opponent_rating = ratings.COMPUTER_RATING
+        if opponent:
+            opponent.add_result(1 - user_score)
+            opponent_rating = opponent.rating or ratings.INITIAL_RATING
+        user.rating, opponent_rating = ratings.updated_ratings(
+            user.rating or ratings.INITIAL_RATING, opponent_rating,
+            user_score)
+        if opponent:
+            opponent.rating = opponent_rating
+        yield ndb.put_multi_async([self] + players)
+        raise ndb.Return(zip(old_ratings,
+                             [player.rating for player in players]))
 
+    @ndb.tasklet
+    def record_result_async(self, won, draw, rating_changes):
+        """Writes the scores, rank index and statistics of a game finished
+        by finish_async. Call it once the finish is committed; the counters
+        are not part of any transaction and must not be applied twice."""
+        if(draw):
+            won = False
         # Add the game results to the score 'board'
         score_user = Score(user=self.user, date=date.today(), 
             won=won, moves=self.user_moves)
-        score_user.put()
-        score_opponent = Score(user=self.user, date=date.today(), 
-            won=not(won), moves=self.opponent_moves)
-        score_opponent.put()
-
-    def is_game_over(self):
-        board, player_one, player_two = self.board_state, 1, 2
-        x_states, o_states = set(), set()
-        possible_wins = [
-            {0, 1, 2}, {3, 4, 5}, {6, 7, 8}, # horizontal win
-            {0, 3, 6}, {1, 4, 7}, {2, 5, 8}, # vertical win
-            {0, 4, 8}, {6, 4, 2}             # diagonal win
-        ]
-        for i in range(len(board)):
-            if(board[i] == player_one):
-                x_states.add(i)
-            elif(board[i] == player_two):
-                o_states.add(i)
-        for win in possible_wins:
-            if(len(win.intersection(x_states)) == 3):
-                return 1    # Player one won
-            elif(len(win.intersection(o_states)) == 3):
-                return 2    # Player two won
-        return 0
+        score_opponent = Score(user=self.opponent, date=date.today(), 
+            won=not(won or draw), moves=self.opponent_moves)
+        yield ([ratings.move_async(old, new) for old, new in rating_changes] +
+               [ndb.put_multi_async([score_user, score_opponent]),
+                stats.record_async(
+                   active_games=-1, active_user_moves=-self.user_moves,
+                   finished_games=1,
+                   finished_moves=self.user_moves + self.opponent_moves,
+                   user_wins=int(won), opponent_wins=int(not(won or draw)),
+                   draws=int(draw),
+                   computer_wins=int(self.single_player and
+                                     not(won or draw)),
+                   computer_losses=int(self.single_player and won))])
+
+    def stats_deltas(self):
+        """Returns the statistics deltas that count the game as it is now,
+        for games that are not counted yet"""
+        if not self.game_over:
+            return {'active_games': 1, 'active_user_moves': self.user_moves}
+        won = board.winner(self.board_state, self.board_size, self.win_length)
+        return {'finished_games': 1,
+                'finished_moves': self.user_moves + self.opponent_moves,
+                'user_wins': int(won == 1), 'opponent_wins': int(won == 2),
+                'draws': int(won == 0),
+                'computer_wins': int(self.single_player and won == 2),
+                'computer_losses': int(self.single_player and won == 1)}
+
+    def player_names(self):
+        """Returns a dict mapping player numbers (1 and 2) to user names"""
+        names = fetch_user_names([self.user, self.opponent])
+        return {1: names.get(self.user), 2: names.get(self.opponent)}
+
+    def record_move(self, board_ind, player):
+        """Appends a move by player (1 or 2) to the packed move log"""
+        self.move_log = movelog.append(self.move_log, self.board_size,
+                                       board_ind, player)
+
+    def get_moves(self):
+        """Returns the moves made so far as (board index, player) pairs"""
+        return movelog.unpack(self.move_log, self.board_size)
+
+    def migrate_moves_history(self, names):
+        """Converts the deprecated moves_history strings into the packed
+        move log. names maps User keys to names. Returns True if the game
+        was changed and needs to be saved."""
+        if not self.moves_history:
+            return False
+        moves, cell_count = [], len(self.board_state)
+        for entry in self.moves_history:
+            match = MOVES_HISTORY_ENTRY.match(entry)
+            if not match:
+                continue
+            player = 1 if match.group(1) == names.get(self.user) else 2
+            moves.append(((int(match.group(2)) - 1) % cell_count, player))
+        if not self.move_log:
+            self.move_log = movelog.pack(moves, self.board_size)
+        self.moves_history = []
+        return True
+
+    def is_game_over(self, last_move=None):
+        """Returns the player who won the game (1 or 2) or 0 if nobody has
+        won yet. last_move is the board index of the most recent move, which
+        lets larger boards only check the lines running through it."""
+        return board.check_winner(self.board_state, self.board_size,
+                                  self.win_length, last_move)
+
+    def is_board_full(self):
+        """Returns True if there is no empty slot left on the board"""
+        return 0 not in self.board_state
 
 
 class Score(ndb.Model):
@@ -125,26 +459,175 @@ class Score(ndb.Model):
     won = ndb.BooleanProperty(required=True)
     moves = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    @classmethod
+    def to_forms(cls, scores, user=None):
+        """Returns ScoreForms for a list of scores, resolving the users of
+        every score in one batch. If all scores belong to one known user,
+        pass it as user; the scores then need not include the user property
+        (e.g. projections of a query filtered on it)."""
+        if user:
+            return [ScoreForm(user_name=user.name, won=score.won,
+                              date=str(score.date), moves=score.moves)
+                    for score in scores]
+        names = fetch_user_names([score.user for score in scores])
+        return [score.to_form(names) for score in scores]
+
+    def to_form(self, names=None):
+        """Returns a ScoreForm representation of the Score. names maps User
+        keys to names; it is fetched when not given."""
+        if names is None:
+            names = fetch_user_names([self.user])
+        return ScoreForm(user_name=names.get(self.user), won=self.won,
                          date=str(self.date), moves=self.moves)
 
 
+@ndb.tasklet
+def _moved_user_async(user):
+    """Returns the copy of a User with a numeric id that copy_to_name_key
+    has made, or the User itself if it was not copied"""
+    if not isinstance(user.key.id(), (int, long)):
+        raise ndb.Return(user)
+    copy = yield ndb.Key(User, user.name).get_async()
+    if copy and copy.legacy_key == user.key:
+        raise ndb.Return(copy)
+    raise ndb.Return(user)
+
+
+# Properties holding User keys, by model
+USER_REFERENCES = ((Game, ('user', 'opponent')), (Score, ('user',)))
+
+
+@ndb.transactional_tasklet
+def _remap_user_async(key, names, old_key, new_key):
+    entity = yield key.get_async()
+    if not entity:
+        return
+    changed = False
+    for name in names:
+        if getattr(entity, name) == old_key:
+            setattr(entity, name, new_key)
+            changed = True
+    if changed:
+        yield entity.put_async()
+
+
+def remap_user_references(old_key, new_key, batch_size):
+    """Points one batch of the Games, Scores and MatchTickets referencing a
+    User key to another key. Every entity is updated in its own
+    transaction, so moves made at the same time are not lost. Returns True
+    once no references to old_key were found."""
+    # matchmaking imports this module
+    from matchmaking import MatchTicket
+    futures, done = [], True
+    for model, names in USER_REFERENCES + ((MatchTicket, ('user',)),):
+        for name in names:
+            keys = model.query(model._properties[name] == old_key).fetch(
+                batch_size, keys_only=True)
+            done = done and not keys
+            futures.extend(_remap_user_async(key, names, old_key, new_key)
+                           for key in keys)
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    return done
+
+
+@ndb.transactional_tasklet
+def _rate_user_async(key):
+    user = yield key.get_async()
+    if not user or user.rating is not None:
+        raise ndb.Return(False)
+    user.rating = ratings.INITIAL_RATING
+    yield user.put_async()
+    raise ndb.Return(True)
+
+
+def rate_unrated_users(users):
+    """Gives the Users of a batch without a rating the initial rating and
+    counts them in the rank index. Every User is rated in its own
+    transaction that only sets a rating that is still None, so results of
+    games ending at the same time are kept. The computer stays unrated.
+    Returns the number of Users rated."""
+    futures = [_rate_user_async(user.key) for user in users
+               if user.rating is None and user.name != COMPUTER_NAME]
+    rated = sum(1 for future in futures if future.get_result())
+    if rated:
+        ratings.move_async(None, ratings.INITIAL_RATING, rated).get_result()
+    return rated
+
+
+@ndb.transactional_tasklet
+def _migrate_moves_history_async(key, names):
+    game = yield key.get_async()
+    if game and game.migrate_moves_history(names):
+        yield game.put_async()
+
+
+def migrate_moves_histories(games):
+    """Converts the deprecated moves_history strings of a batch of Games
+    into packed move logs. Every game is converted in its own transaction
+    on a fresh copy, so moves made since the batch was read are kept."""
+    names = fetch_user_names([game.user for game in games])
+    futures = [_migrate_moves_history_async(game.key, names)
+               for game in games if game.moves_history]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+@ndb.transactional_tasklet
+def _count_game_async(key):
+    game = yield key.get_async()
+    undated = game and game.game_over and not game.finished
+    if not game or (game.counted and not undated):
+        raise ndb.Return({})
+    deltas = {} if game.counted else game.stats_deltas()
+    game.counted = True
+    if undated:
+        # Finished before the finish time was kept; archived from now on
+        game.finished = datetime.now()
+    yield game.put_async()
+    raise ndb.Return(deltas)
+
+
+def count_games(keys):
+    """Adds a batch of Games created before the running statistics to
+    them. Every game is marked as counted in its own transaction, so it is
+    only ever counted once, also when it is moved on at the same time.
+    Finished games without a finish time are given the current time, so
+    they are archived too. Returns the number of games counted."""
+    futures = [_count_game_async(key) for key in keys]
+    totals = {}
+    for future in futures:
+        for field, delta in future.get_result().items():
+            totals[field] = totals.get(field, 0) + delta
+    if totals:
+        stats.record(**totals)
+    return totals.get('active_games', 0) + totals.get('finished_games', 0)
+
+
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. A not_modified form
+    only carries the urlsafe_key, version and message."""
     urlsafe_key = messages.StringField(1, required=True)
     board_state = messages.IntegerField(2, repeated=True)
-    game_over = messages.BooleanField(3, required=True)
+    game_over = messages.BooleanField(3)
     message = messages.StringField(4, required=True)
-    user_moves = messages.IntegerField(5, required=True)
-    opponent_moves = messages.IntegerField(6, required=True)
-    user_name = messages.StringField(7, required=True)
-    opponent_name = messages.StringField(8, required=True)
+    user_moves = messages.IntegerField(5)
+    opponent_moves = messages.IntegerField(6)
+    user_name = messages.StringField(7)
+    opponent_name = messages.StringField(8)
+    board_size = messages.IntegerField(9)
+    win_length = messages.IntegerField(10)
+    version = messages.IntegerField(11)
+    not_modified = messages.BooleanField(12, default=False)
     
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
-    opponent_name = messages.StringField(2, required=True)
+    opponent_name = messages.StringField(2)
+    board_size = messages.IntegerField(3, default=board.DEFAULT_BOARD_SIZE)
+    win_length = messages.IntegerField(4, default=board.DEFAULT_WIN_LENGTH)
 
 
 class MakeMoveForm(messages.Message):
@@ -152,8 +635,91 @@ class MakeMoveForm(messages.Message):
     move = messages.IntegerField(1, required=True)
     player_name = messages.StringField(2, required=True)
 
+class MoveForm(messages.Message):
+    """MoveForm for a single move of a game"""
+    ply = messages.IntegerField(1, required=True)
+    player_name = messages.StringField(2, required=True)
+    move = messages.IntegerField(3, required=True)
+
+class GameReplayForm(messages.Message):
+    """GameReplayForm for the moves of a game and the board at a given ply"""
+    urlsafe_key = messages.StringField(1, required=True)
+    ply = messages.IntegerField(2, required=True)
+    board_state = messages.IntegerField(3, repeated=True)
+    moves = messages.MessageField(MoveForm, 4, repeated=True)
+
+class BatchMoveForm(messages.Message):
+    """A single move of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    player_name = messages.StringField(2, required=True)
+    move = messages.IntegerField(3, required=True)
+
+class BatchMovesForm(messages.Message):
+    """Used to make many moves at once"""
+    moves = messages.MessageField(BatchMoveForm, 1, repeated=True)
+
+class BatchMoveResultForm(messages.Message):
+    """Outcome of a single move of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    ok = messages.BooleanField(2, default=False)
+    message = messages.StringField(3)
+    game = messages.MessageField(GameForm, 4)
+
+class BatchMoveResultsForm(messages.Message):
+    """Return the outcome of every move of a batch"""
+    results = messages.MessageField(BatchMoveResultForm, 1, repeated=True)
+
+class HintForm(messages.Message):
+    """HintForm for the best next move in a game"""
+    move = messages.IntegerField(1, required=True)
+    outcome = messages.StringField(2, required=True)
+
+class GameStatsForm(messages.Message):
+    """GameStatsForm for outbound running game statistics"""
+    active_games = messages.IntegerField(1, required=True)
+    average_moves = messages.FloatField(2, required=True)
+    finished_games = messages.IntegerField(3, required=True)
+    average_game_length = messages.FloatField(4, required=True)
+    user_win_ratio = messages.FloatField(5, required=True)
+    opponent_win_ratio = messages.FloatField(6, required=True)
+    draw_ratio = messages.FloatField(7, required=True)
+    cancelled_games = messages.IntegerField(8, required=True)
+    computer_wins = messages.IntegerField(9, required=True)
+    computer_losses = messages.IntegerField(10, required=True)
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm for outbound game cache counters"""
+    hits = messages.IntegerField(1, required=True)
+    misses = messages.IntegerField(2, required=True)
+    evictions = messages.IntegerField(3, required=True)
+    cas_conflicts = messages.IntegerField(4, required=True)
+    invalidations = messages.IntegerField(5, required=True)
+    hit_rate = messages.FloatField(6, required=True)
+
+class ContentionStatsForm(messages.Message):
+    """ContentionStatsForm for outbound move transaction conflict counters"""
+    moves = messages.IntegerField(1, required=True)
+    conflicts = messages.IntegerField(2, required=True)
+    failures = messages.IntegerField(3, required=True)
+    conflicts_per_move = messages.FloatField(4, required=True)
+
+class MatchTicketForm(messages.Message):
+    """MatchTicketForm for outbound matchmaking state"""
+    user_name = messages.StringField(1, required=True)
+    matched = messages.BooleanField(2, required=True)
+    urlsafe_game_key = messages.StringField(3)
+    wait_seconds = messages.FloatField(4, required=True)
+
+class MatchmakingStatsForm(messages.Message):
+    """MatchmakingStatsForm for outbound matchmaking queue statistics"""
+    queue_depth = messages.IntegerField(1, required=True)
+    matched_players = messages.IntegerField(2, required=True)
+    average_time_to_match = messages.FloatField(3, required=True)
+
 class GetHighScoresForm(messages.Message):
+    """Used to page through the high scores"""
     number_of_results = messages.IntegerField(1)
+    cursor = messages.StringField(2)
 
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
@@ -166,14 +732,18 @@ class UserRankingForm(messages.Message):
     """UserRanking for outbound Rank information"""
     user_name = messages.StringField(1, required=True)
     performance = messages.FloatField(2, required=True)
+    rating = messages.FloatField(3)
+    rank = messages.IntegerField(4)
 
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class UserRankingsForm(messages.Message):
     """Return multiple UserRankings"""
     users = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
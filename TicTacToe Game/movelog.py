@@ -0,0 +1,55 @@
+"""movelog.py - Packed encoding of the moves made in a game.
+
+Each move is stored as one unsigned integer, (board index << 1) | (player - 1),
+so the player is kept even though turns are not enforced. Boards of up to
+11x11 fit a move in one byte; larger boards use two bytes per move. Values
+are stored little-endian."""
+
+import sys
+from array import array
+
+MAX_BYTE_CELLS = 128
+
+
+def _typecode(size):
+    return 'B' if size * size <= MAX_BYTE_CELLS else 'H'
+
+
+def encode_move(index, player):
+    """Returns the packed value of a move"""
+    return index << 1 | (player - 1)
+
+
+def decode_move(value):
+    """Returns (index, player) for a packed move"""
+    return value >> 1, (value & 1) + 1
+
+
+def pack(moves, size):
+    """Packs a list of (index, player) moves into a byte string"""
+    packed = array(_typecode(size), [encode_move(i, p) for i, p in moves])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def unpack(data, size):
+    """Returns the list of (index, player) moves in a packed byte string"""
+    packed = array(_typecode(size))
+    packed.fromstring(data or '')
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return [decode_move(value) for value in packed]
+
+
+def append(data, size, index, player):
+    """Returns the packed byte string with one more move at the end"""
+    return (data or '') + pack([(index, player)], size)
+
+
+def replay(moves, size, ply=None):
+    """Returns the board after the first ply moves (all moves by default)"""
+    cells = [0] * (size * size)
+    for index, player in moves[:ply]:
+        cells[index] = player
+    return cells
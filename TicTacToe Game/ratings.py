@@ -0,0 +1,180 @@
+"""ratings.py - Elo ratings and a bucketed rank index.
+
+Ratings are updated with the Elo formula when a game ends. To answer "what
+is my rank" without scanning users, the number of users per rating bucket
+is kept in sharded counters: a user's rank is the number of users in higher
+buckets plus the users above them within their own bucket. Each shard holds
+the counts of all buckets, so moving a user between buckets is a single
+small transaction on one random shard.
+
+Every user starts at the initial rating and moves less than K_FACTOR per
+game, so most users are rated close to it. That band is also counted in
+narrow fine buckets, so the users counted with a query stay few there too.
+The fine counts of users rated before the fine buckets existed are added
+by /tasks/build_rank_index; until then ranks in the band use the wide
+buckets."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+INITIAL_RATING = 1500.0
+# Fixed rating of the computer player, which is never updated
+COMPUTER_RATING = INITIAL_RATING
+K_FACTOR = 32
+BUCKET_WIDTH = 25
+NUM_BUCKETS = 160
+# Band counted in fine buckets; its ends are also wide bucket boundaries
+FINE_LOW = 1400
+FINE_HIGH = 1600
+FINE_BUCKET_WIDTH = 2
+NUM_FINE_BUCKETS = (FINE_HIGH - FINE_LOW) // FINE_BUCKET_WIDTH
+NUM_SHARDS = 20
+# Fine counts of the users rated before the fine buckets, see set_fine_base
+FINE_BASE_ID = 'fine-base'
+MEMCACHE_BUCKETS = 'RATING_INDEX'
+BUCKETS_CACHE_SECONDS = 5
+
+
+class RatingBucketShard(ndb.Model):
+    """One shard of the number of users in each rating bucket"""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    fine_counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+def expected_score(rating, other_rating):
+    """Returns the expected score (0 to 1) of a player against another"""
+    return 1.0 / (1 + 10 ** ((other_rating - rating) / 400.0))
+
+
+def updated_ratings(user_rating, opponent_rating, user_score):
+    """Returns the new (user, opponent) ratings after a game. user_score is
+    1 for a win of the user, 0.5 for a draw and 0 for a loss."""
+    change = K_FACTOR * (user_score - expected_score(user_rating,
+                                                     opponent_rating))
+    return user_rating + change, opponent_rating - change
+
+
+def bucket(rating):
+    """Returns the bucket a rating is counted in"""
+    return min(max(int(rating // BUCKET_WIDTH), 0), NUM_BUCKETS - 1)
+
+
+def bucket_upper_bound(index):
+    """Returns the rating where the bucket ends, or None for the top one"""
+    if index == NUM_BUCKETS - 1:
+        return None
+    return (index + 1) * BUCKET_WIDTH
+
+
+def fine_bucket(rating):
+    """Returns the fine bucket a rating is counted in, or None if it is
+    outside the fine band"""
+    if not FINE_LOW <= rating < FINE_HIGH:
+        return None
+    return int((rating - FINE_LOW) // FINE_BUCKET_WIDTH)
+
+
+def fine_bucket_bounds():
+    """Returns the (lower, upper) ratings of every fine bucket"""
+    return [(FINE_LOW + i * FINE_BUCKET_WIDTH,
+             FINE_LOW + (i + 1) * FINE_BUCKET_WIDTH)
+            for i in range(NUM_FINE_BUCKETS)]
+
+
+def _deltas(rating, count):
+    """Returns the counts to change for count users with a rating, keyed
+    by (property, index)"""
+    deltas = {('counts', bucket(rating)): count}
+    fine = fine_bucket(rating)
+    if fine is not None:
+        deltas[('fine_counts', fine)] = count
+    return deltas
+
+
+def _add(totals, counts):
+    # Shards written before the fine buckets have no fine counts
+    if not counts:
+        return totals
+    return [a + b for a, b in zip(totals, counts)]
+
+
+@ndb.transactional_tasklet(
+    propagation=ndb.TransactionOptions.INDEPENDENT)
+def _apply_async(shard_id, deltas):
+    shard = yield RatingBucketShard.get_by_id_async(shard_id)
+    if not shard:
+        shard = RatingBucketShard(id=shard_id, counts=[0] * NUM_BUCKETS)
+    if not shard.fine_counts:
+        shard.fine_counts = [0] * NUM_FINE_BUCKETS
+    for (name, index), delta in deltas.items():
+        getattr(shard, name)[index] += delta
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def move_async(old_rating, new_rating, count=1):
+    """Moves count users from the buckets of old_rating to the buckets of
+    new_rating. An old_rating of None adds new users."""
+    deltas = _deltas(new_rating, count)
+    if old_rating is not None:
+        for index, delta in _deltas(old_rating, -count).items():
+            deltas[index] = deltas.get(index, 0) + delta
+    deltas = dict((index, delta) for index, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    yield _apply_async(
+        'shard-{}'.format(random.randint(0, NUM_SHARDS - 1)), deltas)
+
+
+def _shard_keys():
+    return [ndb.Key(RatingBucketShard, 'shard-{}'.format(i))
+            for i in range(NUM_SHARDS)]
+
+
+def get_bucket_counts():
+    """Returns (counts, fine_counts): the number of users in each bucket and
+    in each fine bucket, summed over all shards. fine_counts is None until
+    /tasks/build_rank_index has run."""
+    index = memcache.get(MEMCACHE_BUCKETS)
+    if index is None:
+        counts, fine_counts = [0] * NUM_BUCKETS, [0] * NUM_FINE_BUCKETS
+        shards = ndb.get_multi(_shard_keys() +
+                               [ndb.Key(RatingBucketShard, FINE_BASE_ID)])
+        for shard in shards:
+            if shard:
+                counts = _add(counts, shard.counts)
+                fine_counts = _add(fine_counts, shard.fine_counts)
+        index = (counts, fine_counts if shards[-1] else None)
+        memcache.set(MEMCACHE_BUCKETS, index, time=BUCKETS_CACHE_SECONDS)
+    return index
+
+
+def count_above(rating):
+    """Returns (higher, upper): the number of users in the buckets above
+    the one a rating falls in, and the rating where its bucket ends (None
+    for the top bucket). The users above the rating within its own bucket
+    are left to count."""
+    counts, fine_counts = get_bucket_counts()
+    fine = fine_bucket(rating)
+    if fine is not None and fine_counts is not None:
+        return (sum(counts[bucket(FINE_HIGH):]) + sum(fine_counts[fine + 1:]),
+                fine_bucket_bounds()[fine][1])
+    index = bucket(rating)
+    return sum(counts[index + 1:]), bucket_upper_bound(index)
+
+
+def set_fine_base(fine_counts):
+    """Stores the number of users in each fine bucket, counted by a query,
+    as the base of the fine counts. What the shards have counted so far is
+    subtracted, so this can be run again to correct the fine counts."""
+    in_shards = [0] * NUM_FINE_BUCKETS
+    for shard in ndb.get_multi(_shard_keys(), use_cache=False,
+                               use_memcache=False):
+        if shard:
+            in_shards = _add(in_shards, shard.fine_counts)
+    RatingBucketShard(id=FINE_BASE_ID, fine_counts=[
+        count - counted for count, counted in zip(fine_counts, in_shards)
+    ]).put()
+    memcache.delete(MEMCACHE_BUCKETS)
@@ -0,0 +1,161 @@
+"""solver.py - Perfect play for the 3x3 board.
+
+Every position reachable from the empty board (player one moving first) is
+solved once with minimax and stored in a lookup table keyed by the base-3
+encoding of the board. Positions that are rotations or reflections of each
+other share one entry, which brings the ~5.5k reachable positions down to
+627 undecided ones. The table is built lazily on first use, after which a
+best move lookup is a handful of integer operations with no search.
+
+The win check is board.winner, the same one Game.is_game_over uses."""
+
+import board
+
+SIZE = board.DEFAULT_BOARD_SIZE
+CELLS = SIZE * SIZE
+
+# Each symmetry is a permutation: cell i of the transformed board holds
+# cell perm[i] of the original board.
+_GRID = [[row * SIZE + col for col in range(SIZE)] for row in range(SIZE)]
+
+
+def _rotate(grid):
+    return [list(row) for row in zip(*grid[::-1])]
+
+
+def _symmetries():
+    perms, grid = [], _GRID
+    for _ in range(4):
+        for candidate in (grid, [row[::-1] for row in grid]):
+            perms.append(tuple(cell for row in candidate for cell in row))
+        grid = _rotate(grid)
+    return tuple(perms)
+
+SYMMETRIES = _symmetries()
+_POWERS = tuple(3 ** i for i in range(CELLS))
+
+_table = None
+
+
+def encode(cells):
+    """Returns the base-3 integer encoding of a board"""
+    return sum(cell * power for cell, power in zip(cells, _POWERS))
+
+
+def canonical(cells):
+    """Returns (code, perm) for the symmetry of the board with the smallest
+    encoding, perm being the permutation that produced it"""
+    best = None
+    for perm in SYMMETRIES:
+        code = encode([cells[i] for i in perm])
+        if best is None or code < best[0]:
+            best = (code, perm)
+    return best
+
+
+def player_to_move(cells):
+    """Returns the player whose turn it is, assuming player one started"""
+    return 1 if cells.count(1) == cells.count(2) else 2
+
+
+def _pack(move, score):
+    return (score + 16) << 4 | move
+
+
+def _unpack(value):
+    return value & 15, (value >> 4) - 16
+
+
+def _solve(cells, player, table):
+    """Minimax over canonical positions. Returns the score of the position
+    for the player to move: positive for a win (larger when it comes
+    sooner), 0 for a draw, negative for a loss."""
+    code, perm = canonical(cells)
+    if code in table:
+        return _unpack(table[code])[1]
+    empty = [i for i in range(CELLS) if cells[i] == 0]
+    best_move, best_score = None, None
+    for move in empty:
+        cells[move] = player
+        if board.winner(cells):
+            score = len(empty)
+        elif len(empty) == 1:
+            score = 0
+        else:
+            score = -_solve(cells, 3 - player, table)
+        cells[move] = 0
+        if best_score is None or score > best_score:
+            best_move, best_score = move, score
+    if best_move is not None:
+        # Store the move in the canonical frame
+        table[code] = _pack(perm.index(best_move), best_score)
+    return best_score or 0
+
+
+def build_table():
+    """Solves every position reachable from the empty board"""
+    table = {}
+    _solve([0] * CELLS, 1, table)
+    return table
+
+
+def get_table():
+    """Returns the lookup table, building it on first use"""
+    global _table
+    if _table is None:
+        _table = build_table()
+    return _table
+
+
+def lookup(cells):
+    """Returns (move, score) for the player to move, or None if the game is
+    already decided or the position is not reachable in a normal game."""
+    code, perm = canonical(cells)
+    value = get_table().get(code)
+    if value is None:
+        return None
+    move, score = _unpack(value)
+    return perm[move], score
+
+
+def best_move(cells):
+    """Returns the board index of the best move for the player to move, or
+    None if there is no move to make. Falls back to a search for positions
+    outside the table (e.g. when players did not alternate turns)."""
+    if board.winner(cells) or 0 not in cells:
+        return None
+    result = lookup(cells)
+    if result is None:
+        return minimax_best_move(cells)[0]
+    return result[0]
+
+
+def minimax_best_move(cells, player=None):
+    """Returns (move, score) found by a plain minimax search, without the
+    lookup table. Used for unreachable positions and for benchmarking."""
+    cells = list(cells)
+    if player is None:
+        player = player_to_move(cells)
+    empty = [i for i in range(CELLS) if cells[i] == 0]
+    best_move, best_score = None, None
+    for move in empty:
+        cells[move] = player
+        if board.winner(cells):
+            score = len(empty)
+        elif len(empty) == 1:
+            score = 0
+        else:
+            score = -minimax_best_move(cells, 3 - player)[1]
+        cells[move] = 0
+        if best_score is None or score > best_score:
+            best_move, best_score = move, score
+    return best_move, best_score or 0
+
+
+def describe(score):
+    """Returns the expected outcome of a solver score in words"""
+    if score > 0:
+        return 'win'
+    if score < 0:
+        return 'loss'
+    return 'draw'
@@ -0,0 +1,77 @@
+"""stats.py - Running game statistics kept in sharded counters.
+
+Every change to the set of games (a game created, a move by player one, a
+game finished or cancelled) or to the matchmaking queue adds its deltas to
+one randomly chosen shard in a small transaction, so concurrent writers
+rarely touch the same entity group.
+Reads sum a fixed number of shards, which is cached briefly in memcache."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+MEMCACHE_STATS = 'GAME_STATS'
+STATS_CACHE_SECONDS = 5
+FIELDS = ('active_games', 'active_user_moves', 'finished_games',
+          'finished_moves', 'user_wins', 'opponent_wins', 'draws',
+          'cancelled_games', 'queued_players', 'matched_players',
+          'match_wait_ms', 'computer_wins', 'computer_losses')
+
+
+class GameStatsShard(ndb.Model):
+    """One shard of the running game statistics"""
+    active_games = ndb.IntegerProperty(default=0, indexed=False)
+    active_user_moves = ndb.IntegerProperty(default=0, indexed=False)
+    finished_games = ndb.IntegerProperty(default=0, indexed=False)
+    finished_moves = ndb.IntegerProperty(default=0, indexed=False)
+    user_wins = ndb.IntegerProperty(default=0, indexed=False)
+    opponent_wins = ndb.IntegerProperty(default=0, indexed=False)
+    draws = ndb.IntegerProperty(default=0, indexed=False)
+    cancelled_games = ndb.IntegerProperty(default=0, indexed=False)
+    # Matchmaking: players waiting, players matched and their total wait
+    queued_players = ndb.IntegerProperty(default=0, indexed=False)
+    matched_players = ndb.IntegerProperty(default=0, indexed=False)
+    match_wait_ms = ndb.IntegerProperty(default=0, indexed=False)
+    # Results of the computer player, which has no counts of its own
+    computer_wins = ndb.IntegerProperty(default=0, indexed=False)
+    computer_losses = ndb.IntegerProperty(default=0, indexed=False)
+
+
+@ndb.transactional_tasklet(
+    propagation=ndb.TransactionOptions.INDEPENDENT)
+def _apply_async(shard_id, deltas):
+    shard = yield GameStatsShard.get_by_id_async(shard_id)
+    if not shard:
+        shard = GameStatsShard(id=shard_id)
+    for field, delta in deltas.items():
+        setattr(shard, field, getattr(shard, field) + delta)
+    yield shard.put_async()
+
+
+def record_async(**deltas):
+    """Adds the given deltas, e.g. record_async(active_games=1), to a random
+    shard. Returns a Future."""
+    return _apply_async(
+        'shard-{}'.format(random.randint(0, NUM_SHARDS - 1)), deltas)
+
+
+def record(**deltas):
+    """Synchronous record_async"""
+    record_async(**deltas).get_result()
+
+
+def get_totals():
+    """Returns a dict with the sum of every statistic over all shards"""
+    totals = memcache.get(MEMCACHE_STATS)
+    if totals is None:
+        totals = dict.fromkeys(FIELDS, 0)
+        keys = [ndb.Key(GameStatsShard, 'shard-{}'.format(i))
+                for i in range(NUM_SHARDS)]
+        for shard in ndb.get_multi(keys):
+            if shard:
+                for field in FIELDS:
+                    totals[field] += getattr(shard, field)
+        memcache.set(MEMCACHE_STATS, totals, time=STATS_CACHE_SECONDS)
+    return totals
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""archive_analytics.py - Offline statistics over the archived games.
+
+Reads GameArchive records, either from the app through the remote API or
+from a file saved by an earlier run, and loads their packed columns into
+NumPy arrays. All statistics are then computed in batch over every game at
+once: opening frequencies, win rates by first move, average game length by
+board size and per-user results. Games archived twice are counted once.
+
+Run from the project folder:
+    python tools/archive_analytics.py --sdk /path/to/google_appengine \\
+        --host your-app-id.appspot.com --save archives.npz
+    python tools/archive_analytics.py --load archives.npz --top 20"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir)
+FETCH_BATCH_SIZE = 50
+# Columns of a GameArchive and their NumPy types (all little-endian)
+COLUMN_TYPES = (('user_index', '<u2'), ('opponent_index', '<u2'),
+                ('board_size', 'u1'), ('win_length', 'u1'),
+                ('single_player', 'u1'), ('results', 'u1'),
+                ('move_counts', '<u2'))
+MOVES_TYPE = '<u2'
+BOARDS_TYPE = 'u1'
+# The moves and final boards of all games, one game after the other
+SEQUENCE_TYPES = (('moves', MOVES_TYPE), ('boards', BOARDS_TYPE))
+# Values of the results column, see archive.py
+RESULT_DRAW, RESULT_USER_WON, RESULT_OPPONENT_WON = 0, 1, 2
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and the project on sys.path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, PROJECT_DIR)
+
+
+def fetch_archives(host):
+    """Yields every GameArchive of the app, FETCH_BATCH_SIZE per request"""
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(host, '/_ah/remote_api')
+    from archive import GameArchive
+
+    cursor, more = None, True
+    while more:
+        archives, cursor, more = GameArchive.query().fetch_page(
+            FETCH_BATCH_SIZE, start_cursor=cursor)
+        for record in archives:
+            yield record
+
+
+def load_archives(archives):
+    """Returns a dict of arrays with one entry per game of the archives,
+    plus 'players' (user names), 'moves' and 'boards'. Player indexes are
+    made global and duplicate games dropped."""
+    columns = dict((name, []) for name, _ in COLUMN_TYPES + SEQUENCE_TYPES)
+    player_index, game_keys = {}, []
+    for record in archives:
+        local = np.array([player_index.setdefault(key.id(), len(player_index))
+                          for key in record.players], dtype=np.int64)
+        for name, dtype in COLUMN_TYPES + SEQUENCE_TYPES:
+            values = np.frombuffer(getattr(record, name) or '', dtype=dtype)
+            if name in ('user_index', 'opponent_index'):
+                values = local[values]
+            columns[name].append(values)
+        game_keys.extend(key.urlsafe() for key in record.game_keys)
+
+    games = dict((name, np.concatenate(columns[name]) if columns[name]
+                  else np.zeros(0, dtype=dtype))
+                 for name, dtype in COLUMN_TYPES + SEQUENCE_TYPES)
+    games['game_keys'] = np.array(game_keys)
+    games['players'] = np.array(
+        [str(name) for name in sorted(player_index, key=player_index.get)])
+    return drop_duplicates(games)
+
+
+def drop_duplicates(games):
+    """Keeps the first copy of every game key"""
+    _, first = np.unique(games['game_keys'], return_index=True)
+    if len(first) == len(games['game_keys']):
+        return games
+    keep = np.zeros(len(games['game_keys']), dtype=bool)
+    keep[first] = True
+    # Moves and boards are variable length per game, select them by range
+    counts = games['move_counts'].astype(np.int64)
+    move_starts = np.concatenate(([0], np.cumsum(counts)))
+    cells = games['board_size'].astype(np.int64) ** 2
+    board_starts = np.concatenate(([0], np.cumsum(cells)))
+    games['moves'] = np.concatenate(
+        [games['moves'][move_starts[i]:move_starts[i + 1]]
+         for i in np.flatnonzero(keep)] or [np.zeros(0, MOVES_TYPE)])
+    games['boards'] = np.concatenate(
+        [games['boards'][board_starts[i]:board_starts[i + 1]]
+         for i in np.flatnonzero(keep)] or [np.zeros(0, BOARDS_TYPE)])
+    for name, _ in COLUMN_TYPES:
+        games[name] = games[name][keep]
+    games['game_keys'] = games['game_keys'][keep]
+    return games
+
+
+def save(games, path):
+    np.savez_compressed(path, **games)
+
+
+def load(path):
+    with np.load(path) as data:
+        return dict((name, data[name]) for name in data.files)
+
+
+def first_moves(games):
+    """Returns (games, first_cell, first_player, second_cell) arrays for
+    every game with at least two moves, where games holds their indexes"""
+    counts = games['move_counts'].astype(np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    played = np.flatnonzero(counts >= 2)
+    first = games['moves'][starts[played]].astype(np.int64)
+    second = games['moves'][starts[played] + 1].astype(np.int64)
+    return played, first >> 1, (first & 1) + 1, second >> 1
+
+
+def analyze(games, size, top):
+    """Returns a dict of statistics for the games on size x size boards"""
+    results = games['results']
+    counts = games['move_counts'].astype(np.int64)
+    sizes = games['board_size']
+    report = {'games': int(len(results))}
+
+    lengths = {}
+    for board_size in np.unique(sizes):
+        mask = sizes == board_size
+        lengths[int(board_size)] = {
+            'games': int(mask.sum()),
+            'average_length': float(counts[mask].mean())}
+    report['game_length_by_board_size'] = lengths
+
+    played, first_cell, first_player, second_cell = first_moves(games)
+    on_size = sizes[played] == size
+    played, first_cell = played[on_size], first_cell[on_size]
+    first_player, second_cell = first_player[on_size], second_cell[on_size]
+    cells = size * size
+
+    # Openings: the first two moves as one number
+    openings = np.bincount(first_cell * cells + second_cell,
+                           minlength=cells * cells)
+    order = np.argsort(openings)[::-1][:top]
+    report['openings'] = [
+        {'first': int(o // cells) + 1, 'second': int(o % cells) + 1,
+         'games': int(openings[o])} for o in order if openings[o]]
+
+    # Results from the point of view of the player moving first
+    game_results = results[played]
+    first_won = (((game_results == RESULT_USER_WON) & (first_player == 1)) |
+                 ((game_results == RESULT_OPPONENT_WON) & (first_player == 2)))
+    draws = game_results == RESULT_DRAW
+    totals = np.bincount(first_cell, minlength=cells)
+    wins = np.bincount(first_cell, weights=first_won, minlength=cells)
+    drawn = np.bincount(first_cell, weights=draws, minlength=cells)
+    report['win_rate_by_first_move'] = [
+        {'move': cell + 1, 'games': int(totals[cell]),
+         'first_player_win_rate': wins[cell] / totals[cell],
+         'draw_rate': drawn[cell] / totals[cell]}
+        for cell in range(cells) if totals[cell]]
+
+    # Per user: every game counts for both of its players
+    players = games['players']
+    user, opponent = games['user_index'], games['opponent_index']
+    both = np.concatenate((user, opponent))
+    won = np.concatenate((results == RESULT_USER_WON,
+                          results == RESULT_OPPONENT_WON))
+    lost = np.concatenate((results == RESULT_OPPONENT_WON,
+                           results == RESULT_USER_WON))
+    # Moves of player one (the user) per game, from the packed player bits
+    game_of_move = np.repeat(np.arange(len(counts)), counts)
+    user_made = np.bincount(game_of_move,
+                            weights=(games['moves'] & 1) == 0,
+                            minlength=len(counts))
+    moves_made = np.concatenate((user_made, counts - user_made))
+    n = len(players)
+    user_games = np.bincount(both, minlength=n)
+    user_wins = np.bincount(both, weights=won, minlength=n)
+    user_losses = np.bincount(both, weights=lost, minlength=n)
+    user_moves = np.bincount(both, weights=moves_made, minlength=n)
+    order = np.argsort(user_games)[::-1][:top]
+    report['users'] = [
+        {'user_name': players[i], 'games': int(user_games[i]),
+         'wins': int(user_wins[i]), 'losses': int(user_losses[i]),
+         'draws': int(user_games[i] - user_wins[i] - user_losses[i]),
+         'average_moves': user_moves[i] / user_games[i]}
+        for i in order if user_games[i]]
+    return report
+
+
+def print_report(report, size):
+    print 'Games: {}'.format(report['games'])
+    print '\nAverage game length'
+    for board_size, row in sorted(report['game_length_by_board_size'].items()):
+        print '  {0}x{0}: {1:.2f} moves over {2} games'.format(
+            board_size, row['average_length'], row['games'])
+    print '\nMost played openings ({0}x{0})'.format(size)
+    for row in report['openings']:
+        print '  {first:>3} then {second:>3}: {games} games'.format(**row)
+    print '\nWin rate by first move ({0}x{0})'.format(size)
+    for row in report['win_rate_by_first_move']:
+        print ('  {move:>3}: {games:>7} games, first player wins '
+               '{first_player_win_rate:.1%}, draws {draw_rate:.1%}').format(
+                   **row)
+    print '\nMost active users'
+    for row in report['users']:
+        print ('  {user_name:<20} {games:>6} games {wins:>6} won '
+               '{losses:>6} lost {draws:>6} drawn, {average_moves:.2f} '
+               'moves per game').format(**row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--host', help='app to read the archives from')
+    parser.add_argument('--load', help='file saved by an earlier run')
+    parser.add_argument('--save', help='file to save the loaded games to')
+    parser.add_argument('--size', type=int, default=3,
+                        help='board size of the opening statistics')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='file to save the report to')
+    args = parser.parse_args()
+    if not args.load and not args.host:
+        parser.error('one of --host or --load is required')
+
+    if args.load:
+        games = load(args.load)
+    else:
+        setup_sdk(args.sdk)
+        games = load_archives(fetch_archives(args.host))
+    if args.save:
+        save(games, args.save)
+
+    report = analyze(games, args.size, args.top)
+    print_report(report, args.size)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
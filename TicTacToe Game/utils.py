@@ -2,32 +2,35 @@
 
 import logging
 from google.appengine.ext import ndb
-import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+def _invalid_key():
+    # endpoints is only loaded here, so the task handlers importing this
+    # module do not load it on start up
+    import endpoints
+    return endpoints.BadRequestException('Invalid Key')
+
+
+def get_key_by_urlsafe(urlsafe):
+    """Returns the ndb.Key a urlsafe key string encodes. Raises a
+        BadRequestException if the key String is malformed.
     Args:
         urlsafe: A urlsafe key string
-        model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
-    Raises:
-        ValueError:"""
+        The decoded ndb.Key"""
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
+        raise _invalid_key()
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+            raise _invalid_key()
         else:
             raise
 
-    entity = key.get()
+
+def check_kind(entity, model):
+    """Returns the entity, or None if it does not exist. Raises an error if
+        the entity is of the incorrect kind"""
     if not entity:
         return None
     if not isinstance(entity, model):